@@ -28,3 +28,5 @@ LOG.setLevel(_logging.ERROR)
 LOG.addHandler(_logging.StreamHandler())
 LOG.handlers[-1].setFormatter(
     _logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+
+from .profiling import profile
@@ -27,9 +27,11 @@
 
 from __future__ import absolute_import
 import array as _array
+import operator as _operator
 import struct as _struct
 import sys as _sys
 import types as _types
+from multiprocessing.pool import ThreadPool as _ThreadPool
 
 import numpy as _numpy
 
@@ -42,6 +44,7 @@ from .util import assert_null as _assert_null
 from .util import byte_order as _byte_order
 from .util import need_to_reorder_bytes as _need_to_reorder_bytes
 from .util import checksum as _checksum
+from .util import BufferStream as _BufferStream
 
 
 # Numpy doesn't support complex integers by default, see
@@ -332,6 +335,16 @@ class DynamicWaveDataField1 (_DynamicField):
 
     def unpack(self, stream):
         data_b = stream.read(self.data_size)
+        if isinstance(data_b, _numpy.ndarray):
+            # a slice of a memory-mapped file (see ``load(mmap=True)``),
+            # so view it in place instead of copying it.
+            try:
+                return data_b.view(self.dtype).reshape(self.shape, order='F')
+            except ValueError:
+                _LOG.error(
+                    'could not reshape data from {} to {}'.format(
+                        data_b.shape, self.shape))
+                raise
         try:
             data = _numpy.ndarray(
                 shape=self.shape,
@@ -481,6 +494,88 @@ class DynamicLabelsField (DynamicStringField):
         wave_data[self.name] = dim_labels
 
 
+# Characters copied at a time by ``_split_strings``, which bounds its
+# per-character index arrays.
+_SPLIT_BLOCK_SIZE = 2**20
+
+def _split_strings(chars, offsets):
+    r"""Split text wave characters into strings at their end offsets.
+
+    ``chars`` is the text wave's ``S1`` data and ``offsets`` the
+    ``sIndices`` array giving the end of each string.  The result is
+    the same fixed-width bytes array ``numpy.array(strings)`` would
+    give, but it is filled from the contiguous character buffer in a
+    few vectorized steps, so no Python objects are created per string
+    or per character.  The characters are copied in blocks, so the
+    index arrays that places them stay small however large the wave.
+
+    >>> chars = _numpy.frombuffer(b'Maryhadalittle', dtype='S1')
+    >>> strings = _split_strings(chars, [4, 7, 7, 8, 14])
+    >>> strings.dtype.itemsize
+    6
+    >>> b'|'.join(strings) == b'Mary|had||a|little'
+    True
+    >>> strings = _split_strings(chars, _numpy.array([4, 7, 7, 8, 14],
+    ...     dtype='>u4'))
+    >>> b'|'.join(strings) == b'Mary|had||a|little'
+    True
+    >>> _split_strings(chars, [4, 2])
+    Traceback (most recent call last):
+      ...
+    ValueError: (2, array([4, 2]))
+    """
+    offsets = _numpy.asarray(offsets)
+    chars = _numpy.ascontiguousarray(chars).view(_numpy.uint8).ravel()
+    starts = _numpy.concatenate(([0], offsets[:-1]))
+    backwards = _numpy.flatnonzero(offsets < starts)
+    if backwards.size:
+        raise ValueError((offsets[backwards[0]], offsets))
+    # like slicing, strings are cut short at the end of the buffer
+    ends = _numpy.minimum(offsets, chars.size).astype(_numpy.intp)
+    starts = _numpy.minimum(starts, chars.size).astype(_numpy.intp)
+    lengths = ends - starts
+    width = int(max(lengths.max() if lengths.size else 0, 1))
+    strings = _numpy.zeros((offsets.size, width), dtype=_numpy.uint8)
+    flat = strings.reshape(-1)
+    # where each string goes in ``flat``, relative to where it is in
+    # ``chars``
+    shifts = _numpy.arange(offsets.size, dtype=_numpy.intp) * width - starts
+    first = 0
+    while first < offsets.size:
+        start = starts[first]
+        last = max(int(_numpy.searchsorted(
+                    ends, start + _SPLIT_BLOCK_SIZE, side='right')),
+                   first + 1)
+        stop = ends[last - 1]
+        index = _numpy.repeat(shifts[first:last], lengths[first:last])
+        index += _numpy.arange(start, stop, dtype=_numpy.intp)
+        flat[index] = chars[start:stop]
+        first = last
+    return strings.view('S{}'.format(width)).reshape(offsets.shape)
+
+
+def _join_strings(strings):
+    r"""Join text wave strings into characters and end offsets.
+
+    The inverse of ``_split_strings``: returns the ``uint8``
+    characters of all the strings, back to back, and the ``sIndices``
+    offset of the end of each string.  Like the strings themselves,
+    the lengths ignore trailing nulls.
+
+    >>> chars,offsets = _join_strings([b'Mary', b'had', b'', b'a', b'little'])
+    >>> chars.tobytes() == b'Maryhadalittle'
+    True
+    >>> offsets.tolist()
+    [4, 7, 7, 8, 14]
+    """
+    strings = _numpy.asarray(strings, dtype=bytes).reshape(-1)
+    width = strings.dtype.itemsize
+    lengths = _numpy.char.str_len(strings)
+    chars = strings.view(_numpy.uint8).reshape(strings.size, width)
+    chars = chars[_numpy.arange(width) < lengths[:,_numpy.newaxis]]
+    return (chars, _numpy.cumsum(lengths))
+
+
 class DynamicStringIndicesDataField (_DynamicField):
     """String indices used for text waves only
     """
@@ -504,19 +599,7 @@ class DynamicStringIndicesDataField (_DynamicField):
         wave_structure = parents[-1]
         wave_data = self._get_structure_data(parents, data, wave_structure)
         wave_header = wave_data['wave_header']
-        wdata = wave_data['wData']
-        strings = []
-        start = 0
-        for i,offset in enumerate(wave_data['sIndices']):
-            if offset > start:
-                chars = wdata[start:offset]
-                strings.append(b''.join(chars))
-                start = offset
-            elif offset == start:
-                strings.append(b'')
-            else:
-                raise ValueError((offset, wave_data['sIndices']))
-        wdata = _numpy.array(strings)
+        wdata = _split_strings(wave_data['wData'], wave_data['sIndices'])
         shape = [n for n in wave_header['nDim'] if n > 0] or (0,)
         try:
             wdata = wdata.reshape(shape)
@@ -529,6 +612,18 @@ class DynamicStringIndicesDataField (_DynamicField):
 
 
 class DynamicVersionField (_DynamicField):
+    """Pick the version-specific structure for the rest of the wave.
+
+    ``structures`` maps each version number to the structure that
+    replaces the format of the parent's last field.  It is kept on the
+    field (rather than looked up in the module namespace) so private
+    copies made by ``Structure.parse_context`` swap in their own
+    copies of the version-specific structures.
+    """
+    def __init__(self, *args, **kwargs):
+        self.structures = kwargs.pop('structures', {})
+        super(DynamicVersionField, self).__init__(*args, **kwargs)
+
     def pre_pack(self, parents, byte_order):
         raise NotImplementedError()
 
@@ -540,27 +635,22 @@ class DynamicVersionField (_DynamicField):
             need_to_reorder_bytes = _need_to_reorder_bytes(version)
             wave_structure.byte_order = _byte_order(need_to_reorder_bytes)
             _LOG.debug(
-                'get byte order from version: {} (reorder? {})'.format(
-                    wave_structure.byte_order, need_to_reorder_bytes))
+                'get byte order from version: %s (reorder? %s)',
+                wave_structure.byte_order, need_to_reorder_bytes)
         else:
             need_to_reorder_bytes = False
 
         old_format = wave_structure.fields[-1].format
-        if version == 1:
-            wave_structure.fields[-1].format = Wave1
-        elif version == 2:
-            wave_structure.fields[-1].format = Wave2
-        elif version == 3:
-            wave_structure.fields[-1].format = Wave3
-        elif version == 5:
-            wave_structure.fields[-1].format = Wave5
+        structure = self.structures.get(version, None)
+        if structure is not None:
+            wave_structure.fields[-1].format = structure
         elif not need_to_reorder_bytes:
             raise ValueError(
                 'invalid binary wave version: {}'.format(version))
 
         if wave_structure.fields[-1].format != old_format:
-            _LOG.debug('change wave headers from {} to {}'.format(
-                    old_format, wave_structure.fields[-1].format))
+            _LOG.debug('change wave headers from %s to %s',
+                       old_format, wave_structure.fields[-1].format)
             wave_structure.setup()
         elif need_to_reorder_bytes:
             wave_structure.setup()
@@ -569,20 +659,6 @@ class DynamicVersionField (_DynamicField):
         return need_to_reorder_bytes
 
 
-class DynamicWaveField (_DynamicField):
-    def post_unpack(self, parents, data):
-        return
-        raise NotImplementedError()  # TODO
-        checksum_size = bin.size + wave.size
-        wave_structure = parents[-1]
-        if version == 5:
-            # Version 5 checksum does not include the wData field.
-            checksum_size -= 4
-        c = _checksum(b, parents[-1].byte_order, 0, checksum_size)
-        if c != 0:
-            raise ValueError(
-                ('This does not appear to be a valid Igor binary wave file.  '
-                 'Error in checksum: should be 0, is {}.').format(c))
 
 Wave1 = _DynamicStructure(
     name='Wave1',
@@ -630,26 +706,953 @@ Wave5 = _DynamicStructure(
 Wave = _DynamicStructure(
     name='Wave',
     fields=[
-        DynamicVersionField('h', 'version', help='Version number for backwards compatibility.'),
-        DynamicWaveField(Wave1, 'wave', help='The rest of the wave data.'),
+        DynamicVersionField('h', 'version', help='Version number for backwards compatibility.', structures={1: Wave1, 2: Wave2, 3: Wave3, 5: Wave5}),
+        _Field(Wave1, 'wave', help='The rest of the wave data.'),
         ])
 
+# Header-only versions of the Wave* structures, for load_header().
+Header1 = _DynamicStructure(
+    name='Header1',
+    fields=[
+        _Field(BinHeader1, 'bin_header', help='Binary wave header'),
+        _Field(WaveHeader2, 'wave_header', help='Wave header'),
+        ])
+
+Header2 = _DynamicStructure(
+    name='Header2',
+    fields=[
+        _Field(BinHeader2, 'bin_header', help='Binary wave header'),
+        _Field(WaveHeader2, 'wave_header', help='Wave header'),
+        ])
+
+Header3 = _DynamicStructure(
+    name='Header3',
+    fields=[
+        _Field(BinHeader3, 'bin_header', help='Binary wave header'),
+        _Field(WaveHeader2, 'wave_header', help='Wave header'),
+        ])
+
+Header5 = _DynamicStructure(
+    name='Header5',
+    fields=[
+        _Field(BinHeader5, 'bin_header', help='Binary wave header'),
+        _Field(WaveHeader5, 'wave_header', help='Wave header'),
+        ])
+
+WaveHeaders = _DynamicStructure(
+    name='WaveHeaders',
+    fields=[
+        DynamicVersionField('h', 'version', help='Version number for backwards compatibility.', structures={1: Header1, 2: Header2, 3: Header3, 5: Header5}),
+        _Field(Header1, 'wave', help='The wave headers.'),
+        ])
+
+
+def _get_sections(version, bin_header, wave_header_size):
+    """List the ``(name, size)`` of each section after the wave headers.
 
-def load(filename):
+    The sizes mirror the ones the ``Wave*`` structures use while
+    loading.
+    """
+    if version == 5:
+        return [
+            ('wData', bin_header['wfmSize'] - wave_header_size),
+            ('formula', bin_header['formulaSize']),
+            ('note', bin_header['noteSize']),
+            ('data_units', bin_header['dataEUnitsSize']),
+            ('dimension_units', sum(bin_header['dimEUnitsSize'])),
+            ('labels', sum(bin_header['dimLabelsSize'])),
+            ('sIndices', bin_header['sIndicesSize']),
+            ]
+    sections = [('wData', bin_header['wfmSize'] - wave_header_size - 16)]
+    if version in [2, 3]:
+        sections.extend([('padding', 16), ('note', bin_header['noteSize'])])
+    if version == 3:
+        sections.append(('formula', bin_header['formulaSize']))
+    return sections
+
+
+class _HeadStream (object):
+    """Keep the first ``size`` bytes read through a stream.
+
+    ``load`` uses this to checksum the headers as they are parsed
+    instead of reading them twice.
+    """
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.size = size
+        self.chunks = []
+        self.recorded = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.recorded < self.size:
+            chunk = data[:self.size - self.recorded]
+            self.chunks.append(chunk)
+            self.recorded += len(chunk)
+        return data
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+def _peek(stream, size):
+    """Return up to ``size`` of the next bytes without consuming them.
+
+    Buffered streams (including pipes and sockets) are peeked, and
+    other streams read and seeked back.  Returns ``b''`` for a stream
+    that can do neither.
+    """
+    peek = getattr(stream, 'peek', None)
+    if peek is not None:
+        return bytes(peek(size)[:size])
+    try:
+        position = stream.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return b''
+    data = bytes(stream.read(size))
+    stream.seek(position)
+    return data
+
+
+def verify_checksum(buffer, version, byte_order):
+    r"""Check the header checksum of a binary wave in ``buffer``.
+
+    ``buffer`` holds the start of the wave, from its version field,
+    in the file's ``byte_order``.  The 16-bit sum over the checksummed
+    region (which for versions 1, 2 and 3 includes the first 16 bytes
+    after the wave header) must be zero.
+
+    >>> buffer = bytearray(146)
+    >>> verify_checksum(buffer, 3, '<')
+    >>> buffer[100] = 1
+    >>> verify_checksum(buffer, 3, '<')
+    Traceback (most recent call last):
+      ...
+    ValueError: This does not appear to be a valid Igor binary wave file.  Error in checksum: should be 0, is 1.
+    >>> verify_checksum(buffer[:100], 3, '<')
+    Traceback (most recent call last):
+      ...
+    ValueError: not enough data for the version 3 checksum (100 < 146)
+    """
+    try:
+        size = _HEADERS[version][2]
+    except KeyError:
+        raise ValueError('invalid binary wave version: {}'.format(version))
+    if len(buffer) < size:
+        raise ValueError(
+            'not enough data for the version {} checksum ({} < {})'.format(
+                version, len(buffer), size))
+    c = _checksum(buffer, byte_order, 0, size)
+    if c != 0:
+        raise ValueError(
+            ('This does not appear to be a valid Igor binary wave file.  '
+             'Error in checksum: should be 0, is {}.').format(c))
+
+
+def load(filename, mmap=False, checksum=False):
+    """Load an IGOR binary wave from a filename or stream.
+
+    With ``mmap=True`` the file is memory-mapped and ``wData`` is
+    returned as a read-only ``numpy.memmap`` view into it, so the wave
+    data is only paged in as it is accessed.  This requires a real file
+    (a stream must have a ``fileno``).
+
+    With ``checksum=True`` the header checksum is verified (see
+    ``verify_checksum``) on the bytes already read while parsing, and
+    a ``ValueError`` is raised for a corrupt wave.
+    """
     if hasattr(filename, 'read'):
         f = filename  # filename is actually a stream object
     else:
         f = open(filename, 'rb')
     try:
-        Wave.byte_order = '='
-        Wave.setup()
-        data = Wave.unpack_stream(f)
+        with Wave.parse_context() as wave:
+            wave.byte_order = '='
+            wave.setup()
+            if mmap:
+                start = f.tell()
+                stream = _BufferStream(_numpy.memmap(
+                        f, dtype=_numpy.uint8, mode='r', offset=start))
+                data = wave.unpack_stream(stream)
+                f.seek(start + stream.tell())
+                head = stream.buffer
+            elif checksum:
+                stream = _HeadStream(f, _HEADERS[5][2])
+                data = wave.unpack_stream(stream)
+                head = stream.getvalue()
+                if len(head) < _HEADERS[1][2]:
+                    # a short version 1 wave, which has no padding
+                    # field, so peek at the rest of the checksummed bytes
+                    head += _peek(f, _HEADERS[1][2] - len(head))
+            else:
+                data = wave.unpack_stream(f)
+            byte_order = wave.byte_order
+        if checksum:
+            verify_checksum(head, data['version'], byte_order)
     finally:
         if not hasattr(filename, 'read'):
             f.close()
 
     return data
 
+def load_header(filename):
+    """Load the headers of an IGOR binary wave without its data.
+
+    Returns a dict with the ``version``, the ``byte_order`` of the
+    file, the ``bin_header`` and ``wave_header`` under ``wave`` (as
+    ``load`` would), and ``sections``, which maps the name of each
+    following section (``wData``, ``note``, ...) to its ``(offset,
+    size)`` in bytes from the start of the wave.  Only the headers are
+    read; a stream is left positioned just past the end of the wave.
+    """
+    if hasattr(filename, 'read'):
+        f = filename  # filename is actually a stream object
+    else:
+        f = open(filename, 'rb')
+    try:
+        with WaveHeaders.parse_context() as wave_headers:
+            wave_headers.byte_order = '='
+            wave_headers.setup()
+            data = wave_headers.unpack_stream(f)
+            headers = wave_headers.fields[-1].format
+            bin_header_size = headers.fields[0].format.size
+            wave_header_size = headers.fields[1].format.size
+            data['byte_order'] = wave_headers.byte_order
+        version_size = _struct.calcsize(
+            data['byte_order'] + WaveHeaders.fields[0].format)
+        offset = header_end = version_size + bin_header_size + wave_header_size
+        data['sections'] = {}
+        for name,size in _get_sections(
+                data['version'], data['wave']['bin_header'],
+                wave_header_size):
+            data['sections'][name] = (offset, size)
+            offset += size
+        if hasattr(filename, 'read'):
+            f.seek(offset - header_end, 1)  # skip the data and the rest
+    finally:
+        if not hasattr(filename, 'read'):
+            f.close()
+
+    return data
+
+
+# Header structures and the number of bytes from the start of the file
+# covered by the header checksum, from ReadWave.c.  For versions 1, 2
+# and 3 this includes the first 16 bytes after the wave header (the
+# ``wData[4]`` at the end of the C ``WaveHeader2``).
+_HEADERS = {
+    1: (BinHeader1, WaveHeader2, 134),
+    2: (BinHeader2, WaveHeader2, 142),
+    3: (BinHeader3, WaveHeader2, 146),
+    5: (BinHeader5, WaveHeader5, 384),
+    }
+
+# (key: native numpy dtype, value: integer flag), the inverse of
+# TYPE_TABLE.  Type 1 (NT_CMPLX) is only a flag, so complex128 maps
+# to 5 (NT_CMPLX | NT_FP64).
+_TYPE_CODES = dict(
+    (_numpy.dtype(type_), code) for code,type_ in TYPE_TABLE.items()
+    if type_ is not None and code != 1)
+
+
+def _pack_header(structure, header):
+    """Pack a header dict, in the format ``load`` returns, into bytes.
+
+    Character fields may be ``bytes`` or ``S1`` arrays and are padded
+    with nulls (or truncated) to the field size.  Fields missing from
+    ``header`` are set to their default, or zero.
+    """
+    data = {}
+    for field in structure.fields:
+        value = header.get(field.name, None)
+        if field.format == 'c':
+            if value is None:
+                value = b''
+            elif hasattr(value, 'tobytes'):
+                value = value.tobytes()
+            value = value[:field.item_count].ljust(field.item_count, b'\x00')
+            items = [value[i:i+1] for i in range(field.item_count)]
+        else:
+            if value is None:
+                value = field.default or 0
+            items = _numpy.ravel(value).tolist()[:field.item_count]
+            items.extend([0] * (field.item_count - len(items)))
+        if field.array:
+            data[field.name] = _numpy.array(items, dtype=object).reshape(
+                field.count).tolist()
+        else:
+            data[field.name] = items[0]
+    return structure.pack(data)
 
-def save(filename):
-    raise NotImplementedError
+
+def _get_units(units, sizes):
+    """Split optional extended units into one string per dimension.
+
+    ``load`` returns the dimension units joined together, so they are
+    split using the sizes in the loaded ``bin_header`` when possible,
+    and otherwise all belong to the first dimension.
+    """
+    if units is None:
+        return [b''] * MAXDIMS
+    if isinstance(units, bytes):
+        sizes = list(sizes) if sizes is not None else []
+        if len(sizes) != MAXDIMS or sum(sizes) != len(units):
+            sizes = [len(units)] + [0] * (MAXDIMS - 1)
+        split = []
+        start = 0
+        for size in sizes:
+            split.append(units[start:start+size])
+            start += size
+        units = split
+    units = list(units)
+    return units + [b''] * (MAXDIMS - len(units))
+
+
+def _pack_labels(labels):
+    """Pack one dimension's labels into null-terminated 32 byte chunks.
+
+    The inverse of ``DynamicLabelsField.post_unpack``.  Longer labels
+    spill over into as many chunks as they need.
+    """
+    chunks = []
+    for label in labels:
+        size = 32 * (len(label) // 32 + 1)
+        chunks.append(label.ljust(size, b'\x00'))
+    return b''.join(chunks)
+
+
+def _get_type(dtype):
+    "Return the IGOR type flag for numeric wave data."
+    try:
+        return _TYPE_CODES[_numpy.dtype(dtype).newbyteorder('=')]
+    except KeyError:
+        raise ValueError('no IGOR type for {} data'.format(dtype))
+
+
+def _set_shape(version, wave_header, shape):
+    "Set the ``npnts`` (and ``nDim``) header fields for ``shape``."
+    if version == 5:
+        if len(shape) > MAXDIMS:
+            raise ValueError(
+                'too many dimensions for an IGOR wave: {}'.format(shape))
+        wave_header['nDim'] = list(shape) + [0] * (MAXDIMS - len(shape))
+        wave_header.setdefault('sfA', [1] * MAXDIMS)
+    else:
+        if len(shape) > 1:
+            raise ValueError(
+                'multi-dimensional waves need version 5, not {}'.format(
+                    version))
+        wave_header.setdefault('hsA', 1)
+    wave_header['npnts'] = int(_numpy.prod(shape))
+
+
+def _check_name(version, wave_header):
+    "Default the wave name to ``wave0`` and check its length."
+    if version == 5:
+        max_name_length = MAX_WAVE_NAME5
+    else:
+        max_name_length = MAX_WAVE_NAME2
+    wave_header['bname'] = wave_header.get('bname', b'wave0')
+    if len(wave_header['bname']) > max_name_length:
+        raise ValueError(
+            'wave name {!r} longer than {} characters'.format(
+                wave_header['bname'], max_name_length))
+
+
+def _get_formula(wave):
+    """Return a wave's dependency formula with a trailing null.
+
+    ``load`` strips the null that IGOR writes after formulas (see
+    ``DynamicDependencyFormulaField``).
+    """
+    formula = wave.get('formula', b'')
+    if formula and not formula.endswith(b'\x00'):
+        formula += b'\x00'
+    return formula
+
+
+def _get_trailing_sections(version, wave, string_indices=b''):
+    """List the ``(size_field, bytes)`` of each section after the data.
+
+    The inverse of ``_get_sections``.  ``size_field`` names the
+    ``bin_header`` field holding the section's size, or is a
+    ``(name, index)`` pair for the per-dimension sizes in version 5
+    files.  Versions 1, 2 and 3 start with 16 bytes of padding, which
+    has no size field.
+    """
+    if version != 5:
+        sections = [(None, b'\x00' * 16)]
+        if version >= 2:
+            sections.append(('noteSize', wave.get('note', b'')))
+        if version == 3:
+            sections.append(('formulaSize', _get_formula(wave)))
+        return sections
+    sections = [
+        ('formulaSize', _get_formula(wave)),
+        ('noteSize', wave.get('note', b'')),
+        ('dataEUnitsSize', wave.get('data_units', b'')),
+        ]
+    dimension_units = _get_units(
+        wave.get('dimension_units', None),
+        wave.get('bin_header', {}).get('dimEUnitsSize', None))
+    sections.extend(
+        (('dimEUnitsSize', i), units)
+        for i,units in enumerate(dimension_units))
+    labels = list(wave.get('labels', []))
+    labels += [[]] * (MAXDIMS - len(labels))
+    sections.extend(
+        (('dimLabelsSize', i), _pack_labels(l)) for i,l in enumerate(labels))
+    sections.append(('sIndicesSize', string_indices))
+    return sections
+
+
+def _pack_headers(version, byte_order, bin_header, wave_header, data_size,
+                  data_start, sections):
+    """Pack the version and headers of a binary wave.
+
+    Fills in the ``bin_header`` sizes from ``data_size`` (the number
+    of wave data bytes) and the trailing ``sections``, and calculates
+    the checksum, which for versions 1, 2 and 3 also covers
+    ``data_start``, the first 16 bytes following the wave header.
+    """
+    bin_header_structure,wave_header_structure,checksum_size = _HEADERS[
+        version]
+    with wave_header_structure.parse_context() as structure:
+        structure.byte_order = byte_order
+        structure.setup()
+        wave_header_bytes = _pack_header(structure, wave_header)
+    bin_header['wfmSize'] = len(wave_header_bytes) + data_size
+    if version == 5:
+        bin_header['dimEUnitsSize'] = [0] * MAXDIMS
+        bin_header['dimLabelsSize'] = [0] * MAXDIMS
+    else:
+        bin_header['wfmSize'] += 16  # padding
+    if bin_header['wfmSize'] >= 2**31:
+        raise ValueError(
+            ('{} bytes of wave data do not fit in an IGOR binary wave'
+             ).format(data_size))
+    for name,section in sections:
+        if isinstance(name, tuple):
+            name,index = name
+            bin_header[name][index] = len(section)
+        elif name:
+            bin_header[name] = len(section)
+
+    version_bytes = _struct.pack(byte_order + 'h', version)
+    with bin_header_structure.parse_context() as structure:
+        structure.byte_order = byte_order
+        structure.setup()
+        bin_header['checksum'] = 0
+        headers = (version_bytes + _pack_header(structure, bin_header) +
+                   wave_header_bytes)
+        checksummed = headers
+        if len(checksummed) < checksum_size:  # versions 1, 2 and 3
+            checksummed += (data_start + sections[0][1])[:16]
+        checksum = -_checksum(
+            checksummed, byte_order, 0, checksum_size) & 0xffff
+        if checksum >= 0x8000:  # a signed short
+            checksum -= 0x10000
+        bin_header['checksum'] = checksum
+        return (version_bytes + _pack_header(structure, bin_header) +
+                wave_header_bytes)
+
+
+def _write_array(f, array):
+    """Write a contiguous array's buffer to a stream.
+
+    Real files use ``ndarray.tofile``, which is noticeably faster than
+    ``write`` for large arrays.
+    """
+    try:
+        f.fileno()
+    except (AttributeError, IOError, ValueError):  # not a real file
+        f.write(array)
+    else:
+        array.tofile(f)
+
+
+def save(filename, data, version=None, byte_order='='):
+    """Save an IGOR binary wave to a filename or stream.
+
+    ``data`` is either a dict in the format ``load`` returns or just a
+    ``numpy.ndarray`` of wave data, which is saved as ``wave0``.  The
+    header fields describing the data (``type``, ``npnts``, ``nDim``,
+    the section sizes and the checksum) are always recalculated; other
+    header fields are taken from ``data`` when present, so loaded
+    waves can be modified and saved again.
+
+    Text waves (arrays of ``bytes``) and multi-dimensional waves need
+    ``version=5``, which is the default unless ``data`` has its own
+    ``version``.  Versions 1, 2 and 3 are also supported.
+
+    The wave data is written straight from the array's buffer, so
+    saving is about as fast as ``ndarray.tofile``.  A copy is only
+    made if the array has to be byte-swapped, converted to Fortran
+    order or (for text waves) joined.
+    """
+    if isinstance(data, _numpy.ndarray):
+        data = {'wave': {'wData': data}}
+    if version is None:
+        version = data.get('version', 5)
+    if version not in _HEADERS:
+        raise ValueError(
+            'invalid binary wave version: {}'.format(version))
+    if byte_order in '@=':
+        byte_order = _byte_order(False)
+    wave = data['wave']
+    bin_header = dict(wave.get('bin_header', {}))
+    wave_header = dict(wave.get('wave_header', {}))
+
+    wdata = _numpy.asarray(wave['wData'])
+    if wdata.ndim == 0:
+        wdata = wdata.reshape((1,))
+    if wdata.dtype.kind in 'OS':  # text wave
+        if version != 5:
+            raise ValueError(
+                'text waves need version 5, not {}'.format(version))
+        wave_header['type'] = 0
+        wdata,string_indices = _join_strings(wdata)
+        string_indices = string_indices.astype(byte_order + 'i4').tobytes()
+        shape = _numpy.shape(wave['wData']) or (1,)
+    else:
+        wave_header['type'] = _get_type(wdata.dtype)
+        string_indices = b''
+        shape = wdata.shape
+        wdata = wdata.astype(
+            wdata.dtype.newbyteorder(byte_order), order='F', copy=False)
+        wdata = wdata.ravel(order='F')  # a view for Fortran order data
+    if not (version == 3 and wave.get('formula', None) and not wdata.size):
+        # otherwise, keep npnts for dependent waves saved without data
+        # (see DynamicWaveDataField1.pre_unpack)
+        _set_shape(version, wave_header, shape)
+    _check_name(version, wave_header)
+    wave_data = wdata.view(_numpy.uint8)
+    sections = _get_trailing_sections(version, wave, string_indices)
+    headers = _pack_headers(
+        version, byte_order, bin_header, wave_header, wave_data.size,
+        wave_data[:16].tobytes(), sections)
+
+    if hasattr(filename, 'write'):
+        f = filename  # filename is actually a stream object
+    else:
+        f = open(filename, 'wb')
+    try:
+        f.write(headers)
+        _write_array(f, wave_data)
+        for name,section in sections:
+            f.write(section)
+    finally:
+        if not hasattr(filename, 'write'):
+            f.close()
+
+
+class WaveWriter (object):
+    r"""Write an IGOR binary wave one chunk of data at a time.
+
+    For waves that are too large to hold in memory, or whose final
+    length is unknown when writing starts.  The last entry of
+    ``shape`` may be ``None`` for an unknown length, and each chunk
+    passed to ``append`` extends the wave along that last dimension
+    (which is contiguous in IGOR's Fortran order).  ``data`` holds the
+    other wave fields in the format ``save`` takes, without
+    ``wData``.
+
+    Placeholder headers are written when the writer is created, and
+    ``close`` (or leaving a ``with`` block) writes the trailing
+    sections and then seeks back to patch ``npnts``, ``nDim``,
+    ``wfmSize`` and the checksum, so the stream must be seekable.
+
+    >>> import io
+    >>> stream = io.BytesIO()
+    >>> with WaveWriter(stream, _numpy.float32, shape=(2, None),
+    ...                 data={'wave': {'note': b'streamed'}}) as writer:
+    ...     for i in range(3):
+    ...         writer.append(_numpy.arange(2*i, 2*i + 4,
+    ...             dtype=_numpy.float32).reshape((2, 2), order='F'))
+    >>> _ = stream.seek(0)
+    >>> wave = load(stream)['wave']
+    >>> wave['wData']
+    array([[0., 2., 2., 4., 4., 6.],
+           [1., 3., 3., 5., 5., 7.]], dtype=float32)
+    >>> wave['note'] == b'streamed'
+    True
+
+    The result is the same as saving the whole array at once:
+
+    >>> saved = io.BytesIO()
+    >>> save(saved, {'wave': {'wData': wave['wData'], 'note': b'streamed'}})
+    >>> saved.getvalue() == stream.getvalue()
+    True
+
+    Data that would not fit in a wave is rejected before it is
+    written:
+
+    >>> writer = WaveWriter(io.BytesIO(), _numpy.float64)
+    >>> writer._data_size = 2**31 - 400  # as if we had written it
+    >>> writer.append(_numpy.zeros(100))
+    Traceback (most recent call last):
+      ...
+    ValueError: 2147484048 bytes of wave data do not fit in an IGOR binary wave
+    >>> writer.stream.tell()
+    384
+    """
+    def __init__(self, filename, dtype, shape=(None,), data=None,
+                 version=None, byte_order='='):
+        if data is None:
+            data = {'wave': {}}
+        if version is None:
+            version = data.get('version', 5)
+        if version not in _HEADERS:
+            raise ValueError(
+                'invalid binary wave version: {}'.format(version))
+        if byte_order in '@=':
+            byte_order = _byte_order(False)
+        self.version = version
+        self.byte_order = byte_order
+        self.shape = tuple(shape)
+        if None in self.shape[:-1]:
+            raise ValueError(
+                'only the last dimension can have an unknown length: {}'
+                .format(self.shape))
+        self.dtype = _numpy.dtype(dtype).newbyteorder(byte_order)
+        wave = data['wave']
+        self.bin_header = dict(wave.get('bin_header', {}))
+        self.wave_header = dict(wave.get('wave_header', {}))
+        self.wave_header['type'] = _get_type(self.dtype)
+        _check_name(version, self.wave_header)
+        self.sections = _get_trailing_sections(version, wave)
+        self.count = 0  # items written along the last dimension
+        self._data_start = b''  # for the version 1, 2 and 3 checksums
+        if hasattr(filename, 'write'):
+            self.stream = filename  # filename is actually a stream object
+            self._close_stream = False
+        else:
+            self.stream = open(filename, 'wb')
+            self._close_stream = True
+        self.start = self.stream.tell()
+        shape = self.shape[:-1] + (self.shape[-1] or 0,)
+        self.stream.write(self._pack_headers(shape))
+        # wfmSize, which must stay below 2**31, is the size of the wave
+        # header (and padding) plus the data
+        self._data_size = 0
+        self._max_data_size = 2**31 - 1 - (
+            self.bin_header['wfmSize'] -
+            int(_numpy.prod(shape)) * self.dtype.itemsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _pack_headers(self, shape):
+        _set_shape(self.version, self.wave_header, shape)
+        return _pack_headers(
+            self.version, self.byte_order, self.bin_header, self.wave_header,
+            int(_numpy.prod(shape)) * self.dtype.itemsize, self._data_start,
+            self.sections)
+
+    def append(self, data):
+        """Append a chunk of data along the wave's last dimension."""
+        data = _numpy.asarray(data, dtype=self.dtype)
+        if data.ndim == 0:
+            data = data.reshape((1,))
+        if (data.ndim != len(self.shape) or
+                data.shape[:-1] != self.shape[:-1]):
+            raise ValueError(
+                'cannot append {} data to a {} wave'.format(
+                    data.shape, self.shape))
+        data_size = self._data_size + data.size * self.dtype.itemsize
+        if data_size > self._max_data_size:
+            raise ValueError(
+                ('{} bytes of wave data do not fit in an IGOR binary wave'
+                 ).format(data_size))
+        wave_data = data.ravel(order='F').view(_numpy.uint8)
+        if len(self._data_start) < 16:
+            self._data_start += wave_data[:16 - len(self._data_start)
+                                          ].tobytes()
+        _write_array(self.stream, wave_data)
+        self._data_size = data_size
+        self.count += data.shape[-1]
+
+    def close(self):
+        """Write the trailing sections and patch the headers.
+
+        The headers describe the data that was actually appended, even
+        if that differs from the length given in ``shape``.
+        """
+        if self.stream is None:
+            return
+        try:
+            for name,section in self.sections:
+                self.stream.write(section)
+            end = self.stream.tell()
+            self.stream.seek(self.start)
+            self.stream.write(self._pack_headers(
+                    self.shape[:-1] + (self.count,)))
+            self.stream.seek(end)
+        finally:
+            if self._close_stream:
+                self.stream.close()
+            self.stream = None
+
+
+class WaveReader (object):
+    r"""Read parts of an IGOR binary wave's data without loading it all.
+
+    Only the headers are read when the reader is created.  ``read``
+    (or indexing) takes integers and slices, one per dimension, and
+    seeks to read just the bytes they need.  Because IGOR stores
+    ``wData`` in Fortran order, a window along the first dimension, or
+    a column of a 2D wave, is a single contiguous read, while a row
+    takes one read per column.  The result is in the file's byte
+    order, like the ``wData`` from ``load``.
+
+    With ``offset``, reading starts there instead of at the current
+    position of the stream (or the start of the file), for example at
+    a wave record inside a packed experiment.  ``iter_chunks`` walks
+    through the data in pieces along the last dimension.
+
+    >>> import io
+    >>> stream = io.BytesIO()
+    >>> save(stream, _numpy.arange(12, dtype=_numpy.int16).reshape(
+    ...     (3, 4), order='F'), byte_order='>')
+    >>> _ = stream.seek(0)
+    >>> reader = WaveReader(stream)
+    >>> reader.shape, reader.dtype
+    ((3, 4), dtype('>i2'))
+    >>> reader.read()
+    array([[ 0,  3,  6,  9],
+           [ 1,  4,  7, 10],
+           [ 2,  5,  8, 11]], dtype=int16)
+    >>> reader[:, 2]
+    array([6, 7, 8], dtype=int16)
+    >>> reader[1]
+    array([ 1,  4,  7, 10], dtype=int16)
+    >>> reader[-1, ::-2]
+    array([11,  5], dtype=int16)
+    >>> reader[1:, 1:3]
+    array([[4, 7],
+           [5, 8]], dtype=int16)
+    >>> reader[..., 0]
+    array([0, 1, 2], dtype=int16)
+    >>> reader[2, ...]
+    array([ 2,  5,  8, 11], dtype=int16)
+    >>> reader[..., 1, 1:]
+    array([ 4,  7, 10], dtype=int16)
+    >>> reader[2, 3], type(reader[2, 3])
+    (11, <class 'numpy.int16'>)
+    >>> reader[3, 0]
+    Traceback (most recent call last):
+      ...
+    IndexError: index 3 is out of bounds for axis 0 with size 3
+    """
+    def __init__(self, filename, offset=None):
+        if hasattr(filename, 'read'):
+            self.stream = filename  # filename is actually a stream object
+            self._close_stream = False
+        else:
+            self.stream = open(filename, 'rb')
+            self._close_stream = True
+        try:
+            if offset is not None:
+                self.stream.seek(offset)
+            self.start = self.stream.tell()
+            self.header = load_header(self.stream)
+            self.version = self.header['version']
+            self.byte_order = self.header['byte_order']
+            wave_header = self.header['wave']['wave_header']
+            type_ = TYPE_TABLE.get(wave_header['type'], None)
+            if type_ is None:
+                raise ValueError('cannot read parts of text waves')
+            self.dtype = _numpy.dtype(type_).newbyteorder(self.byte_order)
+            offset,size = self.header['sections']['wData']
+            self.offset = self.start + offset
+            if size == 0:  # e.g. a dependent wave saved without data
+                self.shape = (0,)
+            elif self.version == 5:
+                self.shape = tuple(n for n in wave_header['nDim'] if n > 0)
+            else:
+                self.shape = (wave_header['npnts'],)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def _get_ranges(self, key):
+        """Convert an index ``key`` into one ``range`` per dimension.
+
+        Also returns the dimensions that integers index away.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipses = [i for i,k in enumerate(key) if k is Ellipsis]
+        if len(ellipses) > 1:
+            raise IndexError(
+                "an index can only have a single ellipsis ('...')")
+        elif ellipses:
+            i = ellipses[0]
+            key = (key[:i] +
+                   (slice(None),) * max(0, len(self.shape) - len(key) + 1) +
+                   key[i+1:])
+        if len(key) > len(self.shape):
+            raise IndexError(
+                'too many indices for a {}-dimensional wave'.format(
+                    len(self.shape)))
+        key += (slice(None),) * (len(self.shape) - len(key))
+        ranges = []
+        dropped = []
+        for axis,(k,n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                ranges.append(range(*k.indices(n)))
+                continue
+            k = _operator.index(k)
+            if k < 0:
+                k += n
+            if not 0 <= k < n:
+                raise IndexError(
+                    'index {} is out of bounds for axis {} with size {}'
+                    .format(key[axis], axis, n))
+            ranges.append(range(k, k + 1))
+            dropped.append(axis)
+        return (ranges, dropped)
+
+    def read(self, key=slice(None)):
+        """Read the part of the wave data selected by ``key``.
+
+        Like numpy indexing, an integer for every dimension gives a
+        scalar rather than a 0-d array.
+        """
+        ranges,dropped = self._get_ranges(key)
+        shape = tuple(len(r) for r in ranges)
+        if 0 in shape:
+            data = _numpy.empty(shape, dtype=self.dtype, order='F')
+        else:
+            data = self._read(ranges)
+        data = data.reshape(
+            tuple(n for axis,n in enumerate(shape) if axis not in dropped),
+            order='F')
+        if data.ndim == 0:  # like numpy, return a scalar for one item
+            return data[()]
+        return data
+
+    def _read(self, ranges):
+        # Leading dimensions that are read in full, and the first one
+        # that is not, form contiguous chunks of the data.  Each
+        # combination of indices in the remaining (outer) dimensions
+        # starts another chunk.
+        axis = 0
+        while (axis < len(ranges) - 1 and
+               ranges[axis] == range(self.shape[axis])):
+            axis += 1
+        r = ranges[axis]
+        low = min(r[0], r[-1])
+        span = max(r[0], r[-1]) + 1 - low
+        chunk_shape = tuple(self.shape[:axis]) + (span,)
+        chunk_size = int(_numpy.prod(chunk_shape)) * self.dtype.itemsize
+        strides = self.dtype.itemsize * _numpy.cumprod(
+            (1,) + tuple(self.shape[:-1]), dtype=_numpy.int64)
+        offsets = _numpy.zeros((1,), dtype=_numpy.int64)
+        for a in range(axis + 1, len(ranges)):
+            offsets = (offsets[:,_numpy.newaxis] + strides[a] *
+                       _numpy.array(ranges[a], dtype=_numpy.int64)).ravel(
+                order='F')
+        offsets += self.offset + low * strides[axis]
+        buffer = bytearray(chunk_size * len(offsets))
+        view = memoryview(buffer)
+        for i,offset in enumerate(offsets.tolist()):
+            self.stream.seek(offset)
+            chunk = self.stream.read(chunk_size)
+            if len(chunk) < chunk_size:
+                raise ValueError(
+                    'not enough data to read wave data at {} ({} < {})'
+                    .format(offset, len(chunk), chunk_size))
+            view[i*chunk_size:(i+1)*chunk_size] = chunk
+        data = _numpy.frombuffer(buffer, dtype=self.dtype).reshape(
+            chunk_shape + tuple(len(r) for r in ranges[axis+1:]), order='F')
+        if r != range(low, low + span):
+            data = data.take(
+                _numpy.array(r, dtype=_numpy.intp) - low, axis=axis)
+        return data
+
+    def _iter_chunk_keys(self, size, overlap):
+        """Generate the keys of the chunks for ``iter_chunks``."""
+        head = (slice(None),) * (len(self.shape) - 1)
+        start = 0
+        while start < self.shape[-1]:
+            stop = min(start + size, self.shape[-1])
+            yield head + (slice(start, stop),)
+            if stop == self.shape[-1]:
+                break
+            start += size - overlap
+
+    def iter_chunks(self, size, overlap=0, prefetch=False):
+        r"""Iterate over the data in chunks along the last dimension.
+
+        Each chunk holds ``size`` entries of the last dimension
+        (fewer for the final chunk) and all of the other dimensions,
+        so it is a single contiguous read.  Consecutive chunks share
+        ``overlap`` entries, e.g. for filters that need some context.
+        Only one chunk (two with ``prefetch``) is held at a time, so
+        waves larger than memory can be processed.
+
+        With ``prefetch=True`` the next chunk is read on a background
+        thread while the current one is being used.  Don't use the
+        reader (or its stream) for anything else until the iteration
+        is finished.
+
+        >>> import io
+        >>> stream = io.BytesIO()
+        >>> save(stream, _numpy.arange(10, dtype=_numpy.int32))
+        >>> _ = stream.seek(0)
+        >>> reader = WaveReader(stream)
+        >>> for chunk in reader.iter_chunks(4, overlap=1):
+        ...     print(chunk)
+        [0 1 2 3]
+        [3 4 5 6]
+        [6 7 8 9]
+        >>> chunks = reader.iter_chunks(4, prefetch=True)
+        >>> sum(chunk.sum() for chunk in chunks)
+        45
+        >>> list(reader.iter_chunks(2, overlap=2))
+        Traceback (most recent call last):
+          ...
+        ValueError: chunk size (2) must be larger than the overlap (2)
+        """
+        if size <= overlap or overlap < 0:
+            raise ValueError(
+                'chunk size ({}) must be larger than the overlap ({})'.format(
+                    size, overlap))
+        keys = self._iter_chunk_keys(size, overlap)
+        if not prefetch:
+            for key in keys:
+                yield self.read(key)
+            return
+        pool = _ThreadPool(1)
+        try:
+            result = None  # the only read in flight
+            for key in keys:
+                next_result = pool.apply_async(self.read, (key,))
+                if result is not None:
+                    yield result.get()
+                result = next_result
+            if result is not None:
+                yield result.get()
+        finally:
+            pool.close()
+            pool.join()  # wait for any read still using the stream
+
+    def close(self):
+        if self.stream is None:
+            return
+        if self._close_stream:
+            self.stream.close()
+        self.stream = None
@@ -14,15 +14,19 @@ The usual igor folder types are given in the technical reports
 PTN003.ifn and TN003.ifn.
 """
 from __future__ import absolute_import
+import collections as _collections
 import io as _io
 import locale as _locale
+import operator as _operator
 import re as _re
 import sys as _sys
 
 import numpy as _numpy
+from numpy.lib.mixins import NDArrayOperatorsMixin as _NDArrayOperatorsMixin
 
 from .binarywave import MAXDIMS as _MAXDIMS
 from .packed import load as _load
+from .packed import SUPERCEDED_MASK as _SUPERCEDED_MASK
 from .record.base import UnknownRecord as _UnknownRecord
 from .record.folder import FolderStartRecord as _FolderStartRecord
 from .record.folder import FolderEndRecord as _FolderEndRecord
@@ -80,6 +84,93 @@ class History(IgorObject):
     def format(self, indent=0):
         return " "*indent+"<History>"
 
+class Axis(_NDArrayOperatorsMixin):
+    """
+    Lazily computed axis values, matching numpy.linspace(start, stop, n).
+
+    Only the affine description (start, stop, n, and the step delta)
+    is stored.  Integer
+    indexing and slicing compute just the requested values, while
+    other indexing, ndarray methods and attributes (.max(), .tolist(),
+    ...), numpy functions and arithmetic use the full array, which is
+    built on first use and cached.
+    """
+    dtype = _numpy.dtype(_numpy.float64)
+
+    def __init__(self, start, stop, n):
+        self.start = float(start)
+        self.stop = float(stop)
+        self.n = int(n)
+        if self.n > 1:
+            self.delta = (self.stop - self.start) / (self.n - 1)
+        else:
+            self.delta = 0.0
+        self._values = None
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    @property
+    def size(self):
+        return self.n
+
+    ndim = 1
+
+    def __len__(self):
+        return self.n
+
+    def _compute(self, indices):
+        values = indices * self.delta + self.start
+        if self.n > 1:  # like linspace, end exactly on stop
+            values[indices == self.n - 1] = self.stop
+        return values
+
+    def __getitem__(self, key):
+        if self._values is not None:
+            return self._values[key]
+        if isinstance(key, slice):
+            return self._compute(_numpy.arange(*key.indices(self.n)))
+        if isinstance(key, (bool, _numpy.bool_)):
+            return _numpy.asarray(self)[key]
+        try:
+            i = _operator.index(key)
+        except TypeError:  # lists, masks, Ellipsis, tuples, ...
+            return _numpy.asarray(self)[key]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(
+                "index %d is out of bounds for axis with size %d"%(key, self.n))
+        return self._compute(_numpy.array([i]))[0]
+
+    def __getattr__(self, name):
+        # only called for missing attributes, so forward ndarray ones
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.__array__(), name)
+
+    def __iter__(self):
+        return iter(self.__array__())
+
+    def __array__(self, dtype=None, copy=None):
+        if self._values is None:
+            self._values = _numpy.linspace(self.start, self.stop, self.n)
+        if dtype is not None:
+            return self._values.astype(dtype)
+        if copy:
+            return self._values.copy()
+        return self._values
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(_numpy.asarray(x) if isinstance(x, Axis) else x
+                       for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __repr__(self):
+        return "<igor.Axis start %g, stop %g, n %d>"%(
+            self.start, self.stop, self.n)
+
 class Wave(IgorObject):
     """
     Contains the data for a wave
@@ -108,7 +199,7 @@ class Wave(IgorObject):
         self.data_units = tuple(self.data_units)
         self.axis_units.extend(['']*(_MAXDIMS-len(self.axis_units)))
         self.axis_units = tuple(self.axis_units)
-        self.axis = [_numpy.linspace(a,b,c) for a,b,c in zip(sfA, sfB, dims)]
+        self.axis = [Axis(a,b,c) for a,b,c in zip(sfA, sfB, dims)]
         self.formula = d.get('formula', '')
         self.notes = d.get('note', '')
     def format(self, indent=0):
@@ -123,6 +214,85 @@ class Wave(IgorObject):
 
     __repr__ = __str__ = lambda s: "<igor.Wave %s>" % s.format()
 
+def _lazy_attribute(name):
+    def get(self):
+        return getattr(self._load(), name)
+    return property(get, doc="The wave's %s, converted on first access."%name)
+
+class LazyWave(Wave):
+    """
+    A Wave that is only converted when its data is used.
+
+    The name and format() only need the wave headers.  The first access
+    to any other attribute decodes and converts the wave.  If the wave
+    belongs to a WaveCache, it is dropped again when it becomes the
+    least recently used of more than cache.size converted waves.
+    """
+    def __init__(self, record, cache=None):
+        self.name = record.name.decode(ENCODING)
+        self._record = record
+        self._cache = cache
+        self._wave = None
+
+    def _load(self):
+        wave = self._wave
+        if wave is None:
+            wave = self._wave = Wave(self._record)
+        if self._cache is not None:
+            self._cache.touch(self)
+        return wave
+
+    def evict(self):
+        """
+        Drop the converted wave (and the decoded record) to free memory.
+        """
+        self._wave = None
+        self._record.evict()
+
+    data = _lazy_attribute('data')
+    fs = _lazy_attribute('fs')
+    fstop = _lazy_attribute('fstop')
+    fsbottom = _lazy_attribute('fsbottom')
+    data_units = _lazy_attribute('data_units')
+    axis_units = _lazy_attribute('axis_units')
+    axis = _lazy_attribute('axis')
+    formula = _lazy_attribute('formula')
+    notes = _lazy_attribute('notes')
+
+    def format(self, indent=0):
+        if self._wave is not None:
+            return self._wave.format(indent=indent)
+        headers = self._record.headers
+        wave_header = headers['wave']['wave_header']
+        if headers['version'] == 5:
+            shape = [n for n in wave_header['nDim'] if n > 0] or [0]
+        elif headers['sections']['wData'][1] == 0:
+            shape = [0]  # e.g. a dependent wave saved without data
+        else:
+            shape = [wave_header['npnts']]
+        size = "x".join(str(d) for d in shape)
+        return " "*indent+"%s %s (%s)"%(self.name, "data", size)
+
+class WaveCache(object):
+    """
+    Least recently used LazyWaves, evicting beyond size converted waves.
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("cache size must be at least 1, not %s"%size)
+        self.size = size
+        self.waves = _collections.OrderedDict()
+
+    def touch(self, wave):
+        """
+        Mark a wave as the most recently used.
+        """
+        self.waves.pop(id(wave), None)
+        self.waves[id(wave)] = wave
+        while len(self.waves) > self.size:
+            key,oldest = self.waves.popitem(last=False)
+            oldest.evict()
+
 class Recreation(IgorObject):
     """
     Contains the experiment's recreation procedures as plain text.
@@ -174,19 +344,23 @@ class Unknown(IgorObject):
 class Folder(IgorObject):
     """
     Hierarchical record container.
+
+    Waves and subfolders can be looked up by name in constant time,
+    from an index kept up to date by ``append``, so add children with
+    ``append`` rather than by changing ``children`` directly.
     """
     def __init__(self, path):
         self.name = path[-1]
         self.path = path
         self.children = []
+        self._index = {}  # name -> first Folder or Wave with that name
 
     def __getitem__(self, key):
         if isinstance(key, int):
             return self.children[key]
-        else:
-            for r in self.children:
-                if isinstance(r, (Folder,Wave)) and r.name == key:
-                    return r
+        try:
+            return self._index[key]
+        except KeyError:
             raise KeyError("Folder %s does not exist"%key)
 
     def __str__(self):
@@ -199,15 +373,42 @@ class Folder(IgorObject):
         Add a record to the folder.
         """
         self.children.append(record)
-        try:
-            # Record may not have a name, the name may be invalid, or it
-            # may already be in use.   The noname case will be covered by
-            # record.name raising an attribute error.  The others we need
-            # to test for explicitly.
-            if valid_identifier(record.name) and not hasattr(self, record.name):
-                setattr(self, record.name, record)
-        except AttributeError:
-            pass
+        if not isinstance(record, (Folder, Wave)):
+            return  # no name to index (or to set as an attribute)
+        if record.name in self._index:
+            return  # the first record with a name wins
+        self._index[record.name] = record
+        # The name may be invalid or already in use by an attribute.
+        if valid_identifier(record.name) and not hasattr(self, record.name):
+            setattr(self, record.name, record)
+
+    def lookup(self, path):
+        """
+        Find the wave or folder at an Igor path like 'root:a:b:wave'.
+
+        Paths starting with 'root' are absolute and must lie inside
+        this folder.  Other paths (including ones starting with ':')
+        are relative to this folder.  Liberal names may be quoted, as
+        in "root:'my data':wave0".
+        """
+        names = path.split(':')
+        if names[0] == '':
+            names = names[1:]  # explicitly relative
+        elif names[0] == 'root':
+            if names[:len(self.path)] != self.path:
+                raise KeyError(
+                    "%s is not in %s" % (path, ':'.join(self.path)))
+            names = names[len(self.path):]
+        if names and names[-1] == '':
+            names = names[:-1]  # trailing colon for a folder
+        node = self
+        for name in names:
+            if not isinstance(node, Folder):
+                raise KeyError("%s is not a folder" % node.name)
+            if len(name) > 1 and name.startswith("'") and name.endswith("'"):
+                name = name[1:-1]
+            node = node[name]
+        return node
 
     def format(self, indent=0):
         parent = " "*indent+self.name
@@ -220,22 +421,42 @@ def loads(s, **kwargs):
     stream = _io.BytesIO(s)
     return load(stream, **kwargs)
 
-def load(filename, **kwargs):
-    """Load an igor file"""
+def load(filename, lazy=False, cache_size=None, include=None, exclude=None,
+         mmap=False, **kwargs):
+    """Load an igor file
+
+    With lazy=True waves are LazyWaves, which are only decoded and
+    converted when their data is used.  With cache_size=N at most N of
+    them are kept converted at a time; cache_size requires lazy=True.
+
+    include and exclude are igor.packed.RecordFilters selecting the
+    records to load (see igor.packed.load).  Folders are always kept.
+    With mmap=True the file is memory-mapped and the wave data are
+    views into the map.
+    """
+    if cache_size is not None and not lazy:
+        raise ValueError("cache_size requires lazy=True")
     try:
-        packed_experiment = _load(filename)
+        packed_experiment = _load(
+            filename, lazy=lazy, include=include, exclude=exclude,
+            mmap=mmap)
     except ValueError as e:
         if e.args[0].startswith('not enough data for the next record header'):
             raise IOError('invalid record header; bad pxp file?')
         elif e.args[0].startswith('not enough data for the next record'):
             raise IOError('final record too long; bad pxp file?')
         raise
-    return _convert(packed_experiment, **kwargs)
+    if cache_size is not None:
+        kwargs['cache'] = WaveCache(cache_size)
+    return _convert(packed_experiment, lazy=lazy, **kwargs)
 
-def _convert(packed_experiment, ignore_unknown=True):
+def _convert(packed_experiment, ignore_unknown=True, lazy=False, cache=None):
     records, filesystem = packed_experiment
     stack = [Folder(path=['root'])]
     for record in records:
+        if (isinstance(record, (_VariablesRecord, _WaveRecord)) and
+                record.header['recordType'] & _SUPERCEDED_MASK):
+            continue  # replaced by a later (appended) record
         if isinstance(record, _UnknownRecord):
             if ignore_unknown:
                 continue
@@ -254,15 +475,20 @@ def _convert(packed_experiment, ignore_unknown=True):
         elif isinstance(record, _VariablesRecord):
             r = Variables(record)
         elif isinstance(record, _WaveRecord):
-            r = Wave(record)
+            if lazy:
+                r = LazyWave(record, cache=cache)
+            else:
+                r = Wave(record)
         else:
             r = None
 
         if isinstance(record, _FolderStartRecord):
-            path = stack[-1].path + [
-                record.null_terminated_text.decode(ENCODING)]
-            folder = Folder(path)
-            stack[-1].append(folder)
+            name = record.null_terminated_text.decode(ENCODING)
+            folder = stack[-1]._index.get(name, None)
+            if not isinstance(folder, Folder):
+                folder = Folder(stack[-1].path + [name])
+                stack[-1].append(folder)
+            # otherwise the folder was reopened by an appended record
             stack.append(folder)
         elif isinstance(record, _FolderEndRecord):
             stack.pop()
@@ -17,18 +17,42 @@
 
 "Read IGOR Packed Experiment files files into records."
 
+import fnmatch as _fnmatch
+import hashlib as _hashlib
+import io as _io
+import json as _json
+import mmap as _mmap
+import os as _os
+import re as _re
+
+try:
+    import concurrent.futures as _futures
+except ImportError as e:  # Python 2 without `futures`
+    _futures = None
+    _FUTURES_IMPORT_ERROR = e  # Python 3 unbinds `e` after the block
+
+import numpy as _numpy
+
 from . import LOG as _LOG
+from . import profiling as _profiling
+from .binarywave import load_header as _loadibw_header
+from .binarywave import save as _saveibw
+from .binarywave import WaveReader as _WaveReader
 from .struct import Structure as _Structure
 from .struct import Field as _Field
 from .util import byte_order as _byte_order
 from .util import need_to_reorder_bytes as _need_to_reorder_bytes
+from .util import BufferStream as _BufferStream
 from .util import _bytes
 from .record import RECORD_TYPE as _RECORD_TYPE
 from .record.base import UnknownRecord as _UnknownRecord
 from .record.base import UnusedRecord as _UnusedRecord
 from .record.folder import FolderStartRecord as _FolderStartRecord
 from .record.folder import FolderEndRecord as _FolderEndRecord
+from .record.history import HistoryRecord as _HistoryRecord
+from .record.procedure import ProcedureRecord as _ProcedureRecord
 from .record.variables import VariablesRecord as _VariablesRecord
+from .record.variables import pack_variables as _pack_variables
 from .record.wave import WaveRecord as _WaveRecord
 
 
@@ -55,63 +79,430 @@ SUPERCEDED_MASK = 0x8000  # Bit is set if the record is superceded by
                           # a later record in the packed file.
 
 
-def load(filename, strict=True, ignore_unknown=True):
-    _LOG.debug('loading a packed experiment file from {}'.format(filename))
+class RecordFilter (object):
+    r"""Select packed experiment records by path, name and type.
+
+    ``paths`` are shell-style globs (see ``fnmatch``) matched against
+    the Igor path of the record: ``'root:raw:trace17'`` for a wave
+    ``trace17`` in the ``raw`` data folder, or ``'root:raw'`` for the
+    other records in that folder.  ``names`` are regular expressions
+    searched for in wave names, so a filter with ``names`` only
+    matches waves.  ``record_types`` are record classes or their codes
+    from ``igor.record.RECORD_TYPE``.  Each criterion may be a single
+    value or a sequence, and a record matches the filter if it matches
+    one of the values of every criterion given.
+
+    >>> f = RecordFilter(paths='root:raw:*', names=r'^trace\d+$')
+    >>> f.matches(_WaveRecord, (b'root', b'raw'), b'trace17')
+    True
+    >>> f.matches(_WaveRecord, (b'root', b'raw'), b'notes')
+    False
+    >>> f.matches(_WaveRecord, (b'root',), b'trace17')
+    False
+    >>> f.matches(_VariablesRecord, (b'root', b'raw', b'sub'))
+    False
+    >>> f = RecordFilter(record_types=[1, _HistoryRecord])
+    >>> f.matches(_VariablesRecord, (b'root',))
+    True
+    >>> f.matches(_WaveRecord, (b'root',), b'trace17')
+    False
+    """
+    def __init__(self, paths=None, names=None, record_types=None):
+        self.paths = self._list(paths)
+        self.names = self._list(names)
+        self.record_types = self._list(record_types)
+        if self.paths is not None:
+            self.paths = [_bytes(path) for path in self.paths]
+        if self.names is not None:
+            self.names = [_re.compile(_bytes(name)) for name in self.names]
+        if self.record_types is not None:
+            self.record_types = [
+                _RECORD_TYPE.get(t, t) if isinstance(t, int) else t
+                for t in self.record_types]
+
+    def _list(self, values):
+        if values is None or isinstance(values, list):
+            return values
+        if isinstance(values, (tuple, set, frozenset)):
+            return list(values)
+        return [values]
+
+    def __repr__(self):
+        return '<{} paths={} names={} record_types={}>'.format(
+            self.__class__.__name__, self.paths,
+            self.names and [name.pattern for name in self.names],
+            self.record_types and [t.__name__ for t in self.record_types])
+
+    def matches(self, record_type, dirpath, name=None):
+        """Check a record.
+
+        ``dirpath`` is the data folder holding the record, as a tuple
+        of names starting with ``b'root'``, and ``name`` is the wave
+        name for wave records.
+        """
+        if (self.record_types is not None and
+                record_type not in self.record_types):
+            return False
+        if self.names is not None:
+            if name is None:
+                return False
+            if not any(regexp.search(name) for regexp in self.names):
+                return False
+        if self.paths is not None:
+            if name is not None:
+                dirpath = tuple(dirpath) + (name,)
+            path = b':'.join(dirpath)
+            if not any(_fnmatch.fnmatchcase(path, pattern)
+                       for pattern in self.paths):
+                return False
+        return True
+
+
+def _select(record_type, dirpath, name, include=None, exclude=None):
+    """Check a record against ``load``'s ``include`` and ``exclude``."""
+    if include is not None and not include.matches(record_type, dirpath, name):
+        return False
+    if exclude is not None and exclude.matches(record_type, dirpath, name):
+        return False
+    return True
+
+def _skip(f, size):
+    """Move past the next ``size`` bytes of ``f`` without keeping them.
+
+    Seeks if it can, otherwise (e.g. on a pipe) reads and discards.
+    """
+    try:
+        f.seek(size, 1)
+        return
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(remaining, 2**20))
+        if not data:
+            raise ValueError(
+                'not enough data for the next record ({} < {})'.format(
+                    size - remaining, size))
+        remaining -= len(data)
+
+
+def load(filename, strict=True, ignore_unknown=True, lazy=False,
+         workers=None, include=None, exclude=None, mmap=False):
+    """Load an IGOR packed experiment from a filename or stream.
+
+    Returns ``(records, filesystem)``.  With ``lazy=True`` wave records
+    are not decoded until their ``.wave`` is accessed (see
+    ``igor.record.wave.WaveRecord``); the filesystem only needs the
+    wave names, which are read from the wave headers.
+
+    ``include`` and ``exclude`` are ``RecordFilter`` instances selecting
+    the records to load: a record is loaded if it matches ``include`` (or
+    there is no ``include``) and does not match ``exclude``.  The data
+    of the other records is skipped over without being read, except
+    for wave headers, which are read when a filter needs the wave
+    names.  Data folder start and end records are always loaded, so
+    the filesystem keeps all of its folders.
+
+    Each record's ``data`` is read once, and the decoded waves (and
+    variables) are views into it rather than copies.  With
+    ``mmap=True`` the file is memory-mapped instead of read, and the
+    record ``data`` are read-only memoryviews into the map, so wave
+    data is only paged in as it is used.  This requires a real
+    file (a stream must have a ``fileno``).
+
+    With ``workers=N``, wave and variables records are decoded in a
+    pool of ``N`` processes while the file is read.  You can also pass
+    your own ``concurrent.futures.Executor`` as ``workers`` (parsing
+    is thread-safe, so a ``ThreadPoolExecutor`` works too); it is not
+    shut down afterwards.  Either way the records are returned in
+    file order, and the wave data are views into the records' data,
+    as for a serial load, rather than copies sent back by the workers.
+
+    See ``iter_records`` to process records one at a time instead.
+    """
+    _LOG.debug('loading a packed experiment file from %s', filename)
     records = []
+    try:
+        if workers:
+            records = _load_parallel(
+                filename, ignore_unknown=ignore_unknown, lazy=lazy,
+                workers=workers, include=include, exclude=exclude,
+                mmap=mmap)
+        else:
+            for record,path in iter_records(
+                    filename, strict=strict, ignore_unknown=ignore_unknown,
+                    lazy=lazy, include=include, exclude=exclude,
+                    mmap=mmap):
+                records.append(record)
+    finally:
+        _LOG.debug('finished loading %s records from %s',
+                   len(records), filename)
+
+    with _profiling.stage('packed.filesystem'):
+        filesystem = _build_filesystem(records)
+
+    return (records, filesystem)
+
+def iter_records(filename, strict=True, ignore_unknown=True, lazy=False,
+                 include=None, exclude=None, mmap=False):
+    """Iterate through the records of an IGOR packed experiment.
+
+    Yields ``(record, path)`` in file order, where ``path`` is the data
+    folder holding the record, as a tuple of names starting with
+    ``b'root'``.  Data folder start and end records get the path of
+    the folder they start or end.  Records are read one at a time and
+    never revisited, so only the current record's data is held, and
+    ``filename`` may be a non-seekable stream like ``sys.stdin``.
+    ``strict``, ``ignore_unknown``, ``lazy``, ``include``, ``exclude``
+    and ``mmap`` are as for ``load``.
+    """
+    dir_stack = [b'root']
+    for record_type,header,data,byte_order in _read_records(
+            filename, ignore_unknown=ignore_unknown, include=include,
+            exclude=exclude, mmap=mmap):
+        with _profiling.stage('packed.{}'.format(record_type.__name__)):
+            if lazy and record_type is _WaveRecord:
+                record = record_type(
+                    header, data, byte_order=byte_order, lazy=True)
+            else:
+                record = record_type(header, data, byte_order=byte_order)
+        if isinstance(record, _FolderStartRecord):
+            dir_stack.append(record.null_terminated_text)
+            yield (record, tuple(dir_stack))
+        elif isinstance(record, _FolderEndRecord):
+            yield (record, tuple(dir_stack))
+            dir_stack.pop()
+        else:
+            yield (record, tuple(dir_stack))
+
+def _read_records(filename, ignore_unknown=True, include=None,
+                  exclude=None, mmap=False):
+    """Yield ``(record_type, header, data, byte_order)`` for each record.
+
+    Records not selected by ``include`` and ``exclude`` (see ``load``)
+    are skipped.
+    """
     if hasattr(filename, 'read'):
         f = filename  # filename is actually a stream object
     else:
         f = open(filename, 'rb')
+    stream = f
+    if mmap:
+        start = f.tell()
+        try:
+            m = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        except ValueError:  # cannot map an empty file
+            m = b''
+        f = _BufferStream(memoryview(m))
+        f.seek(start)
+    if _profiling.ACTIVE is not None:
+        f = _profiling.ProfilingStream(f, _profiling.ACTIVE)
     byte_order = None
-    initial_byte_order = '='
+    filtered = include is not None or exclude is not None
+    wants_name = any(
+        rf is not None and (rf.paths is not None or rf.names is not None)
+        for rf in [include, exclude])
+    dir_stack = [b'root']
     try:
         while True:
-            PackedFileRecordHeader.byte_order = initial_byte_order
-            PackedFileRecordHeader.setup()
-            b = bytes(f.read(PackedFileRecordHeader.size))
-            if not b:
+            with _profiling.stage('packed.header'):
+                header,byte_order = _read_header(f, byte_order)
+            if header is None:
                 break
-            if len(b) < PackedFileRecordHeader.size:
-                raise ValueError(
-                    ('not enough data for the next record header ({} < {})'
-                     ).format(len(b), PackedFileRecordHeader.size))
-            _LOG.debug('reading a new packed experiment file record')
-            header = PackedFileRecordHeader.unpack_from(b)
-            if header['version'] and not byte_order:
-                need_to_reorder = _need_to_reorder_bytes(header['version'])
-                byte_order = initial_byte_order = _byte_order(need_to_reorder)
-                _LOG.debug(
-                    'get byte order from version: {} (reorder? {})'.format(
-                        byte_order, need_to_reorder))
-                if need_to_reorder:
-                    PackedFileRecordHeader.byte_order = byte_order
-                    PackedFileRecordHeader.setup()
-                    header = PackedFileRecordHeader.unpack_from(b)
-                    _LOG.debug(
-                        'reordered version: {}'.format(header['version']))
-            data = bytes(f.read(header['numDataBytes']))
-            if len(data) < header['numDataBytes']:
-                raise ValueError(
-                    ('not enough data for the next record ({} < {})'
-                     ).format(len(b), header['numDataBytes']))
+            size = header['numDataBytes']
             record_type = _RECORD_TYPE.get(
                 header['recordType'] & PACKEDRECTYPE_MASK, _UnknownRecord)
-            _LOG.debug('the new record has type {} ({}).'.format(
-                    record_type, header['recordType']))
+            head = b''
+            if filtered and record_type is _FolderEndRecord:
+                dir_stack.pop()
+            elif filtered and record_type is not _FolderStartRecord:
+                name = None
+                if record_type is _WaveRecord and wants_name:
+                    with _profiling.stage('packed.data'):
+                        head = f.read(min(size, _WAVE_HEADERS_SIZE))
+                    headers = _loadibw_header(_BufferStream(head))
+                    name = headers['wave']['wave_header']['bname']
+                if not _select(record_type, tuple(dir_stack), name,
+                               include=include, exclude=exclude):
+                    _LOG.debug('skipping a %s record', record_type.__name__)
+                    _skip(f, size - len(head))
+                    continue
+                if head:
+                    try:  # read the whole record at once
+                        f.seek(-len(head), 1)
+                        head = b''
+                    except (AttributeError, IOError, OSError, ValueError):
+                        head = bytes(head)  # non-seekable, so join them
+            with _profiling.stage('packed.data'):
+                data = f.read(size - len(head))
+            if head:
+                data = head + bytes(data)
+            if len(data) < size:
+                raise ValueError(
+                    ('not enough data for the next record ({} < {})'
+                     ).format(len(data), size))
+            if filtered and record_type is _FolderStartRecord:
+                dir_stack.append(bytes(data).split(b'\x00', 1)[0])
+            _LOG.debug('the new record has type %s (%s).',
+                       record_type, header['recordType'])
             if record_type in [_UnknownRecord, _UnusedRecord
                                ] and not ignore_unknown:
                 raise KeyError('unkown record type {}'.format(
                         header['recordType']))
-            records.append(record_type(header, data, byte_order=byte_order))
+            yield (record_type, header, data, byte_order)
     finally:
-        _LOG.debug('finished loading {} records from {}'.format(
-                len(records), filename))
         if not hasattr(filename, 'read'):
-            f.close()
+            stream.close()  # the map (if any) stays open while in use
+        elif mmap:
+            stream.seek(f.tell())
 
-    filesystem = _build_filesystem(records)
+# Records handed to a worker at a time by ``load(workers=...)``,
+# which amortizes the cost of each task.
+_PARALLEL_BATCH_SIZE = 64
+_PARALLEL_BATCH_BYTES = 2**20
 
-    return (records, filesystem)
+class _DataView (object):
+    """Where a decoded wave's ``wData`` lies in its record ``data``.
+
+    Workers send these back instead of the (copied) arrays, and the
+    caller rebuilds the arrays as views into its own ``data``.
+    """
+    def __init__(self, offset, shape, dtype, strides):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.strides = strides
+
+    def view(self, data):
+        return _numpy.ndarray(
+            self.shape, dtype=self.dtype, buffer=data, offset=self.offset,
+            strides=self.strides)
+
+def _detach_wave_data(record):
+    """Replace a wave record's ``wData`` view with a ``_DataView``."""
+    wave = record.wave['wave']
+    wave_data = wave.get('wData', None)
+    if not isinstance(wave_data, _numpy.ndarray) or not wave_data.size:
+        return
+    buffer = _numpy.frombuffer(record.data, dtype=_numpy.uint8)
+    if not _numpy.may_share_memory(wave_data, buffer):
+        return  # e.g. text waves, which are decoded into new arrays
+    offset = (wave_data.__array_interface__['data'][0] -
+              buffer.__array_interface__['data'][0])
+    wave['wData'] = _DataView(
+        offset, wave_data.shape, wave_data.dtype, wave_data.strides)
+
+def _attach_wave_data(record):
+    """Inverse of ``_detach_wave_data``, once ``record.data`` is back."""
+    wave = record.wave['wave']
+    if isinstance(wave.get('wData', None), _DataView):
+        wave['wData'] = wave['wData'].view(record.data)
+
+def _decode_records(jobs):
+    """Create records in a worker for ``load(workers=...)``.
+
+    ``jobs`` is a list of ``(record_type, header, data, byte_order)``.
+    Neither the data nor the wave data views into it are sent back,
+    since the caller already has the data.
+    """
+    records = []
+    for record_type,header,data,byte_order in jobs:
+        record = record_type(header, data, byte_order=byte_order)
+        if isinstance(record, _WaveRecord):
+            _detach_wave_data(record)
+        record.data = None  # the caller still has it, don't send it back
+        records.append(record)
+    return records
+
+def _load_parallel(filename, ignore_unknown=True, lazy=False, workers=None,
+                   include=None, exclude=None, mmap=False):
+    """Read records in order, decoding the expensive ones in ``workers``.
+    """
+    if isinstance(workers, int):
+        if _futures is None:
+            raise _FUTURES_IMPORT_ERROR
+        executor = _futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = workers
+    # memoryviews into a map cannot be pickled for worker processes
+    pickled = _futures is not None and isinstance(
+        executor, _futures.ProcessPoolExecutor)
+    decoded = [_VariablesRecord]
+    if not lazy:
+        decoded.append(_WaveRecord)
+    records = []
+    batches = []  # (future, [record index, ...])
+    jobs = []
+    indices = []
+    size = 0
+    try:
+        for record_type,header,data,byte_order in _read_records(
+                filename, ignore_unknown=ignore_unknown, include=include,
+                exclude=exclude, mmap=mmap):
+            if record_type in decoded:
+                if pickled and isinstance(data, memoryview):
+                    jobs.append((record_type, header, data.tobytes(),
+                                 byte_order))
+                else:
+                    jobs.append((record_type, header, data, byte_order))
+                indices.append(len(records))
+                records.append(data)  # placeholder until decoded
+                size += len(data)
+                if (len(jobs) >= _PARALLEL_BATCH_SIZE or
+                        size >= _PARALLEL_BATCH_BYTES):
+                    batches.append(
+                        (executor.submit(_decode_records, jobs), indices))
+                    jobs = []
+                    indices = []
+                    size = 0
+            elif record_type is _WaveRecord:
+                records.append(record_type(
+                        header, data, byte_order=byte_order, lazy=True))
+            else:
+                records.append(record_type(
+                        header, data, byte_order=byte_order))
+        if jobs:
+            batches.append((executor.submit(_decode_records, jobs), indices))
+        for future,indices in batches:
+            for i,record in zip(indices, future.result()):
+                record.data = records[i]
+                if isinstance(record, _WaveRecord):
+                    _attach_wave_data(record)
+                records[i] = record
+    finally:
+        if executor is not workers:
+            executor.shutdown()
+    return records
+
+def _read_header(f, byte_order=None):
+    """Read the next record header from ``f``.
+
+    Returns ``(header, byte_order)``.  Until a header with a nonzero
+    version shows the file's byte order, ``byte_order`` is ``None``.
+    At the end of the file ``header`` is ``None``.
+    """
+    with PackedFileRecordHeader.parse_context() as structure:
+        structure._use_byte_order(byte_order or '=')
+        b = bytes(f.read(structure.size))
+        if not b:
+            return (None, byte_order)
+        if len(b) < structure.size:
+            raise ValueError(
+                ('not enough data for the next record header ({} < {})'
+                 ).format(len(b), structure.size))
+        _LOG.debug('reading a new packed experiment file record')
+        header = structure.unpack_from(b)
+        if header['version'] and not byte_order:
+            need_to_reorder = _need_to_reorder_bytes(header['version'])
+            byte_order = _byte_order(need_to_reorder)
+            _LOG.debug(
+                'get byte order from version: %s (reorder? %s)',
+                byte_order, need_to_reorder)
+            if need_to_reorder:
+                structure._use_byte_order(byte_order)
+                header = structure.unpack_from(b)
+                _LOG.debug('reordered version: %s', header['version'])
+    return (header, byte_order)
 
 def _build_filesystem(records):
     # From PTN003:
@@ -152,9 +543,14 @@ def _build_filesystem(records):
     dir_stack = [('root', filesystem['root'])]
     for record in records:
         cwd = dir_stack[-1][-1]
+        if (isinstance(record, (_VariablesRecord, _WaveRecord)) and
+                record.header['recordType'] & SUPERCEDED_MASK):
+            continue  # replaced by a later record (see ``save``)
         if isinstance(record, _FolderStartRecord):
             name = record.null_terminated_text
-            cwd[name] = {}
+            if not isinstance(cwd.get(name, None), dict):
+                cwd[name] = {}
+            # otherwise the folder was reopened by an appended record
             dir_stack.append((name, cwd[name]))
         elif isinstance(record, _FolderEndRecord):
             dir_stack.pop()
@@ -172,7 +568,7 @@ def _build_filesystem(records):
                     _check_filename(dir_stack, filename)
                     cwd[filename] = value
             else:  # WaveRecord
-                filename = record.wave['wave']['wave_header']['bname']
+                filename = record.name
                 _check_filename(dir_stack, filename)
                 cwd[filename] = record
     return filesystem
@@ -192,3 +588,504 @@ def walk(filesystem, callback, dirpath=None):
         callback(dirpath, key, value)
         if isinstance(value, dict):
             walk(filesystem=value, callback=callback, dirpath=dirpath+[key])
+
+
+# Enough of a wave record for its version, bin header and wave header
+# (2 + 62 + 320 bytes in version 5, less in earlier versions).
+_WAVE_HEADERS_SIZE = 384
+
+# Bump when the cached index format changes.
+_INDEX_CACHE_VERSION = 1
+# Size of the leading and trailing blocks hashed to detect changes.
+_INDEX_CACHE_BLOCK_SIZE = 65536
+
+
+def _get_file_key(filename):
+    """Identify the current contents of a file for the index cache.
+
+    Uses the path, size, and modification time, and a hash of the
+    first and last blocks to catch edits that keep the size and
+    modification time.
+    """
+    stat = _os.stat(filename)
+    digest = _hashlib.sha1()
+    with open(filename, 'rb') as f:
+        digest.update(f.read(_INDEX_CACHE_BLOCK_SIZE))
+        if stat.st_size > _INDEX_CACHE_BLOCK_SIZE:
+            f.seek(max(_INDEX_CACHE_BLOCK_SIZE,
+                       stat.st_size - _INDEX_CACHE_BLOCK_SIZE))
+            digest.update(f.read(_INDEX_CACHE_BLOCK_SIZE))
+    return {
+        'path': _os.path.abspath(filename),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': digest.hexdigest(),
+        }
+
+
+class PackedIndex (object):
+    """Index of the records in a packed experiment file.
+
+    Building the index only reads the record headers, the names of
+    data folders, and the headers of waves, seeking over all other
+    record data.  ``.records`` has an entry for each record (in file
+    order), with the record ``header``, ``recordType`` (without the
+    superceded bit), ``version``, ``superceded`` flag, the ``offset``
+    and ``numDataBytes`` of the record data, and the record's
+    ``path``.  Paths are tuples of names starting with ``b'root'``;
+    for waves and data folders the path ends with their own name,
+    for other records it is the enclosing data folder.  ``.paths``
+    maps those paths to the entries.
+
+    ``.get`` reads a single wave (or data folder start) record with
+    one seek and read, and ``.reader`` opens a wave for partial or
+    chunked reads of its data.  If ``filename`` is a stream it must be
+    seekable and stay open while the index is used.
+
+    With ``cache=True`` the index is saved to a JSON sidecar file
+    next to the experiment (``filename + '.index'``), or to the path
+    given as ``cache``.  Later indexes of the same file load the
+    sidecar instead of scanning the file, as long as the file's path,
+    size, modification time, and first and last blocks are
+    unchanged; otherwise the file is scanned and the sidecar
+    rewritten.  ``.cached`` is ``True`` if the sidecar was used.
+    """
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        self.byte_order = None
+        self.records = []
+        self.paths = {}
+        self.cached = False
+        if cache and not hasattr(filename, 'read'):
+            if cache is True:
+                cache = '{}.index'.format(filename)
+            key = _get_file_key(filename)
+            self.cached = self._read_cache(cache, key)
+            if not self.cached:
+                self._scan()
+                self._write_cache(cache, key)
+        else:
+            self._scan()
+
+    def _add(self, entry):
+        self.records.append(entry)
+        if _RECORD_TYPE.get(entry['recordType'], None) in [
+                _FolderStartRecord, _WaveRecord]:
+            previous = self.paths.get(entry['path'], None)
+            if (previous is None or previous['superceded'] or
+                    not entry['superceded']):
+                self.paths[entry['path']] = entry
+
+    def _scan(self):
+        _LOG.debug('indexing a packed experiment file from %s', self.filename)
+        if hasattr(self.filename, 'read'):
+            f = self.filename  # filename is actually a stream object
+        else:
+            f = open(self.filename, 'rb')
+        try:
+            start = f.tell()
+            f.seek(0, 2)
+            end = f.tell()
+            f.seek(start)
+            dir_stack = [b'root']
+            while True:
+                header,self.byte_order = _read_header(f, self.byte_order)
+                if header is None:
+                    break
+                offset = f.tell()
+                size = header['numDataBytes']
+                if offset + size > end:
+                    raise ValueError(
+                        ('not enough data for the next record ({} < {})'
+                         ).format(end - offset, size))
+                record_type = _RECORD_TYPE.get(
+                    header['recordType'] & PACKEDRECTYPE_MASK, _UnknownRecord)
+                path = None
+                if record_type is _FolderStartRecord:
+                    data = bytes(f.read(size))
+                    name = record_type(header, data).null_terminated_text
+                    dir_stack.append(name)
+                elif record_type is _FolderEndRecord:
+                    dir_stack.pop()
+                elif record_type is _WaveRecord:
+                    data = bytes(f.read(min(size, _WAVE_HEADERS_SIZE)))
+                    headers = _loadibw_header(_io.BytesIO(data))
+                    name = headers['wave']['wave_header']['bname']
+                    path = tuple(dir_stack) + (name,)
+                if path is None:
+                    path = tuple(dir_stack)
+                self._add({
+                    'header': header,
+                    'recordType': header['recordType'] & PACKEDRECTYPE_MASK,
+                    'version': header['version'],
+                    'superceded': bool(
+                        header['recordType'] & SUPERCEDED_MASK),
+                    'offset': offset,
+                    'numDataBytes': size,
+                    'path': path,
+                    })
+                f.seek(offset + size)
+        finally:
+            _LOG.debug('finished indexing %s records from %s',
+                       len(self.records), self.filename)
+            if not hasattr(self.filename, 'read'):
+                f.close()
+
+    def _read_cache(self, cache, key):
+        """Load ``.records`` from a sidecar file if it matches ``key``."""
+        try:
+            with open(cache, 'r') as f:
+                data = _json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            _LOG.debug('could not read index cache %s: %s', cache, e)
+            return False
+        if (data.get('version') != _INDEX_CACHE_VERSION or
+                data.get('key') != key):
+            _LOG.debug('stale index cache %s', cache)
+            return False
+        self.byte_order = data['byte_order']
+        if self.byte_order is not None:
+            self.byte_order = str(self.byte_order)
+        for entry in data['records']:
+            entry['header'] = dict(
+                (str(k), v) for k,v in entry['header'].items())
+            entry['path'] = tuple(
+                name.encode('latin-1') for name in entry['path'])
+            self._add(dict((str(k), v) for k,v in entry.items()))
+        _LOG.debug('loaded %s records from index cache %s',
+                   len(self.records), cache)
+        return True
+
+    def _write_cache(self, cache, key):
+        """Save ``.records`` to a sidecar file (best effort)."""
+        records = []
+        for entry in self.records:
+            entry = dict(entry)
+            entry['path'] = [name.decode('latin-1') for name in entry['path']]
+            records.append(entry)
+        data = {
+            'version': _INDEX_CACHE_VERSION,
+            'key': key,
+            'byte_order': self.byte_order,
+            'records': records,
+            }
+        tmp = '{}.tmp{}'.format(cache, _os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                _json.dump(data, f)
+            getattr(_os, 'replace', _os.rename)(tmp, cache)
+        except (IOError, OSError) as e:
+            _LOG.warning('could not write index cache %s: %s', cache, e)
+            try:
+                _os.remove(tmp)
+            except OSError:
+                pass
+
+    def _get_key(self, path):
+        if hasattr(path, 'split'):
+            path = _bytes(path).split(b':')
+        key = []
+        for name in path:
+            name = _bytes(name)
+            if len(name) > 1 and name.startswith(b"'") and name.endswith(b"'"):
+                name = name[1:-1]  # quoted liberal name
+            key.append(name)
+        return tuple(key)
+
+    def get(self, path):
+        """Read the wave or data folder start record at ``path``.
+
+        ``path`` is an Igor path like ``'root:data:trace17'`` or a
+        sequence of names.
+        """
+        try:
+            entry = self.paths[self._get_key(path)]
+        except KeyError:
+            raise KeyError(path)
+        return self.read(entry)
+
+    def reader(self, path):
+        """Open a ``binarywave.WaveReader`` on the wave at ``path``.
+
+        The reader reads parts of the wave's data straight from the
+        experiment file, without reading the whole record.
+        """
+        try:
+            entry = self.paths[self._get_key(path)]
+        except KeyError:
+            raise KeyError(path)
+        if _RECORD_TYPE.get(entry['recordType'], None) is not _WaveRecord:
+            raise ValueError('{} is not a wave'.format(path))
+        return _WaveReader(self.filename, offset=entry['offset'])
+
+    def read(self, entry):
+        """Read the record for an entry from ``.records``.
+
+        If ``filename`` is a stream, its position is restored
+        afterwards.
+        """
+        data = self._read_data(entry)
+        record_type = _RECORD_TYPE.get(entry['recordType'], _UnknownRecord)
+        return record_type(entry['header'], data, byte_order=self.byte_order)
+
+    def _read_data(self, entry, size=None):
+        """Read the first ``size`` bytes (default all) of a record."""
+        if size is None:
+            size = entry['numDataBytes']
+        if hasattr(self.filename, 'read'):
+            f = self.filename  # filename is actually a stream object
+            position = f.tell()
+        else:
+            f = open(self.filename, 'rb')
+        try:
+            f.seek(entry['offset'])
+            return bytes(f.read(min(size, entry['numDataBytes'])))
+        finally:
+            if hasattr(self.filename, 'read'):
+                f.seek(position)
+            else:
+                f.close()
+
+
+# (key: record class, value: record type), the inverse of RECORD_TYPE
+# for the records ``save`` writes.
+_RECORD_CODES = dict(
+    (record_type, code) for code,record_type in _RECORD_TYPE.items()
+    if record_type in [_VariablesRecord, _HistoryRecord, _WaveRecord,
+                       _ProcedureRecord, _FolderStartRecord,
+                       _FolderEndRecord])
+
+# System variable names (K0, K1, ...)
+_SYSTEM_VARIABLE_REGEXP = _re.compile(b'^K([0-9]+)$')
+
+
+def _is_wave(value):
+    """Return ``True`` if a filesystem value is a wave (not a folder)."""
+    if isinstance(value, (_WaveRecord, _numpy.ndarray)):
+        return True
+    return (isinstance(value, dict) and
+            isinstance(value.get('wave', None), dict) and
+            'wData' in value['wave'])
+
+def _pack_record_header(record_type, num_data_bytes, byte_order='='):
+    # Record headers with a zero version do not show their byte order,
+    # so ``_read_header`` reads them in the native one unless an
+    # earlier header in the file showed another.
+    with PackedFileRecordHeader.parse_context() as structure:
+        structure._use_byte_order(byte_order)
+        return structure.pack({
+                'recordType': _RECORD_CODES[record_type],
+                'version': 0,
+                'numDataBytes': num_data_bytes,
+                })
+
+def _write_record(f, record_type, data, header_byte_order='='):
+    f.write(_pack_record_header(record_type, len(data), header_byte_order))
+    f.write(data)
+
+def _write_wave(f, name, wave, byte_order, header_byte_order='='):
+    """Write a wave record, saving the wave straight to ``f``.
+
+    Loaded ``WaveRecord``\\s with the same name are copied unchanged.
+    Otherwise the record header is written with no size, patched
+    after ``binarywave.save`` has written the wave.
+    """
+    if isinstance(wave, _WaveRecord):
+        if wave.data is not None and wave.name == name:
+            _write_record(f, _WaveRecord, bytes(wave.data),
+                          header_byte_order)
+            return
+        wave = wave.wave
+    elif isinstance(wave, _numpy.ndarray):
+        wave = {'wave': {'wData': wave}}
+    data = dict(wave)
+    data['wave'] = dict(wave['wave'])
+    data['wave']['wave_header'] = dict(data['wave'].get('wave_header', {}))
+    data['wave']['wave_header']['bname'] = name
+    start = f.tell()
+    header = _pack_record_header(_WaveRecord, 0, header_byte_order)
+    f.write(header)
+    _saveibw(f, data, byte_order=byte_order)
+    end = f.tell()
+    f.seek(start)
+    f.write(_pack_record_header(
+            _WaveRecord, end - start - len(header), header_byte_order))
+    f.seek(end)
+
+def _get_records(index, record_type, path=None):
+    """List the index entries of current records of a given type."""
+    if index is None:
+        return []
+    return [entry for entry in index.records
+            if _RECORD_TYPE.get(entry['recordType'], None) is record_type
+            and not entry['superceded']
+            and (path is None or entry['path'] == path)]
+
+def _has_dependent_variables(index, entry):
+    """Return ``True`` if a variables record has dependent variables.
+
+    Only version 2 records have them.  Their counts are read from the
+    start of the record, since ``VariablesRecord`` cannot parse them.
+    """
+    data = index._read_data(entry, 12)  # version and VarHeader2
+    if len(data) < 12:
+        return False
+    version = _numpy.frombuffer(data[:2], dtype='=i2')[0]
+    byte_order = _byte_order(_need_to_reorder_bytes(version))
+    version,num_sys,num_user,num_strs,num_dep_vars,num_dep_strs = (
+        _numpy.frombuffer(data, dtype=byte_order + 'i2').tolist())
+    return version == 2 and (num_dep_vars > 0 or num_dep_strs > 0)
+
+def _write_folder(f, folder, path, byte_order, index, superceded,
+                  header_byte_order='='):
+    """Write the variables, waves and subfolders of a data folder.
+
+    ``index`` is the ``PackedIndex`` of the file being appended to (or
+    ``None``), and the entries of records replaced by the new ones are
+    added to ``superceded``.  The record headers are packed in
+    ``header_byte_order``.
+    """
+    namespace = {}
+    sys_vars = {}
+    waves = []
+    folders = []
+    for name,value in folder.items():
+        name = _bytes(name)
+        if _is_wave(value):
+            waves.append((name, value))
+        elif isinstance(value, dict):
+            folders.append((name, value))
+        else:
+            match = _SYSTEM_VARIABLE_REGEXP.match(name)
+            if match and len(path) == 1:
+                sys_vars[int(match.group(1))] = value
+            else:
+                namespace[name] = value
+    if namespace or sys_vars:
+        old_namespace = {}
+        for entry in _get_records(index, _VariablesRecord, path):
+            if _has_dependent_variables(index, entry):
+                raise ValueError(
+                    'cannot append variables to {}: its dependent variables '
+                    'would lose their formulas'.format(
+                        ':'.join(name.decode('ascii', 'replace')
+                                 for name in path)))
+            variables = index.read(entry).variables['variables']
+            for key in ['userVars', 'userStrs']:
+                old_namespace.update(variables[key])
+            if len(path) == 1:
+                for key,value in variables['sysVars'].items():
+                    sys_vars.setdefault(int(key[1:]), value)
+            superceded.append(entry)
+        old_namespace.update(namespace)
+        _write_record(f, _VariablesRecord, _pack_variables(
+                old_namespace,
+                [sys_vars.get(i, 0) for i in range(
+                        max(sys_vars) + 1 if sys_vars else 0)],
+                byte_order=byte_order),
+                      header_byte_order)
+    for name,wave in waves:
+        entry = index.paths.get(path + (name,), None) if index else None
+        if (entry is not None and not entry['superceded'] and
+                _RECORD_TYPE.get(entry['recordType'], None) is _WaveRecord):
+            superceded.append(entry)
+        _write_wave(f, name, wave, byte_order, header_byte_order)
+    for name,subfolder in folders:
+        if len(name) > 31:
+            raise ValueError(
+                'data folder name {!r} longer than 31 characters'.format(
+                    name))
+        _write_record(f, _FolderStartRecord, name.ljust(32, b'\x00'),
+                      header_byte_order)
+        _write_folder(f, subfolder, path + (name,), byte_order, index,
+                      superceded, header_byte_order)
+        _write_record(f, _FolderEndRecord, b'', header_byte_order)
+
+def save(filename, filesystem, history=None, procedure=None, append=False,
+         byte_order='='):
+    r"""Save a filesystem dict as an IGOR packed experiment.
+
+    ``filesystem`` is laid out like the one ``load`` returns, with
+    nested dicts for data folders under ``'root'``.  Waves can be
+    ``WaveRecord``\s (copied unchanged if their name matches their
+    key), dicts in the format ``binarywave.load`` returns, or arrays.
+    Other values are variables: ``bytes`` for strings and numbers for
+    numeric variables.  In the root folder ``K0``, ``K1``, ... are
+    saved as system variables.  ``history`` and ``procedure`` are the
+    text of the history and procedure window records.  Other records
+    (pictures, settings, ...) are not part of the filesystem, so they
+    are not saved.
+
+    With ``append=True`` the records are added to the end of an
+    existing experiment, so only the new data is written.  The
+    records they replace (waves with the same path, the variables
+    records of folders with new variables, whose other variables are
+    carried over, and earlier history and procedure records) are then
+    marked with ``SUPERCEDED_MASK``.  The marks are only set once the
+    new records have been written, so an interrupted append leaves the
+    old records in use, and an append that fails is truncated away.
+    Records cannot be inserted into a folder's existing records, so
+    data folders that get new data are reopened with another folder
+    start record, and ``load`` merges the two.  Carried over variables
+    are saved as plain user variables, so appending variables to a
+    folder with dependent variables raises ``ValueError`` rather than
+    dropping their formulas.
+
+    ``byte_order`` is used for the waves and variables (which record
+    their byte order), while the record headers, which do not, use
+    the native byte order readers assume.  When appending to an
+    experiment whose headers show another byte order, the new records
+    use the file's byte order instead, since readers apply it to every
+    later header.  ``filename`` may also be a stream, which must be
+    seekable since the sizes of wave records are patched after each
+    wave is written.
+    """
+    if byte_order in '@=':
+        byte_order = _byte_order(False)
+    index = None
+    header_byte_order = '='
+    if append:
+        index = PackedIndex(filename)
+        if index.byte_order:
+            byte_order = header_byte_order = index.byte_order
+    if hasattr(filename, 'write'):
+        f = filename  # filename is actually a stream object
+    elif append:
+        f = open(filename, 'r+b')
+    else:
+        f = open(filename, 'wb')
+    try:
+        if append:
+            f.seek(0, 2)
+        start = f.tell()
+        superceded = []
+        try:
+            if history is not None:
+                superceded.extend(_get_records(index, _HistoryRecord))
+                _write_record(f, _HistoryRecord, _bytes(history),
+                              header_byte_order)
+            _write_folder(f, filesystem['root'], (b'root',), byte_order,
+                          index, superceded, header_byte_order)
+            if procedure is not None:
+                superceded.extend(_get_records(index, _ProcedureRecord))
+                _write_record(f, _ProcedureRecord, _bytes(procedure),
+                              header_byte_order)
+        except:
+            if append:  # drop the partial records
+                f.seek(start)
+                f.truncate()
+            raise
+        if superceded:
+            end = f.tell()
+            f.flush()
+            with PackedFileRecordHeader.parse_context() as structure:
+                structure._use_byte_order(header_byte_order)
+                for entry in superceded:
+                    header = dict(entry['header'])
+                    header['recordType'] |= SUPERCEDED_MASK
+                    f.seek(entry['offset'] - structure.size)
+                    f.write(structure.pack(header))
+            f.seek(end)
+    finally:
+        if not hasattr(filename, 'write'):
+            f.close()
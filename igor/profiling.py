@@ -0,0 +1,227 @@
+# This file is part of igor.
+#
+# igor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# igor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with igor.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Opt-in profiling of the parsing stages.
+
+While a profile is active (see ``profile``), ``DynamicStructure``
+parsing and ``packed.load`` accumulate statistics for each structure,
+field, hook and record type they process.  When no profile is
+active the parsers only check ``ACTIVE``, so this costs nothing in
+production until you turn it on.
+
+Statistics are kept per name in ``Profile.stats``:
+
+``calls``
+  number of times the stage ran
+``seconds``
+  wall time, including any nested stages and reads
+``self_seconds``
+  wall time excluding nested stages and reads
+``read_seconds``, ``reads``, ``bytes``
+  time spent in, number of and bytes returned by the stream ``read``
+  calls made directly by the stage
+``allocated``
+  net bytes allocated by the stage (only with ``memory=True``)
+
+Names are ``Structure`` for a whole (dynamic) structure,
+``Structure.field`` for a field (or ``Structure.first..last`` for a
+run of plain fields decoded together), ``Structure.field:pre_unpack``
+and ``Structure.field:post_unpack`` for hooks, and ``packed.*`` for
+the packed experiment stages.  Records decoded in worker processes
+(``packed.load(workers=...)``) are not profiled.
+"""
+
+from __future__ import absolute_import
+import contextlib as _contextlib
+import threading as _threading
+import time as _time
+
+try:
+    import tracemalloc as _tracemalloc
+except ImportError:  # Python < 3.4
+    _tracemalloc = None
+
+
+_timer = getattr(_time, 'perf_counter', _time.time)
+
+# The profile collecting statistics, or ``None``.
+ACTIVE = None
+
+_STAT_NAMES = [
+    'calls', 'seconds', 'self_seconds', 'read_seconds', 'reads', 'bytes',
+    'allocated']
+
+
+class Profile (object):
+    """Statistics collected while a profile is active.
+
+    Stages running in different threads are all collected, each
+    thread keeping its own stack of nested stages.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = {}
+        self._lock = _threading.Lock()
+        self._local = _threading.local()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, name, **kwargs):
+        with self._lock:
+            stats = self.stats.get(name, None)
+            if stats is None:
+                stats = self.stats[name] = dict(
+                    (key, 0) for key in _STAT_NAMES)
+            for key,value in kwargs.items():
+                stats[key] += value
+
+    def _get_memory(self):
+        if self.memory:
+            return _tracemalloc.get_traced_memory()[0]
+        return 0
+
+    def start(self, name):
+        """Start timing a stage (use ``stage`` where possible)."""
+        # name, start time, time in nested stages, start memory
+        self._get_stack().append([name, _timer(), 0, self._get_memory()])
+
+    def stop(self):
+        """Stop timing the innermost stage."""
+        stack = self._get_stack()
+        name,start,nested,memory = stack.pop()
+        seconds = _timer() - start
+        if stack:
+            stack[-1][2] += seconds
+        self._add(name, calls=1, seconds=seconds,
+                  self_seconds=seconds - nested,
+                  allocated=self._get_memory() - memory)
+
+    @_contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage in a ``with`` block."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def add_read(self, seconds, size):
+        """Charge a stream read to the innermost stage."""
+        stack = self._get_stack()
+        if stack:
+            stack[-1][2] += seconds
+            name = stack[-1][0]
+        else:
+            name = 'read'
+        self._add(name, read_seconds=seconds, reads=1, bytes=size)
+
+    def as_dict(self):
+        """Return a copy of the statistics."""
+        with self._lock:
+            return dict((name, dict(stats))
+                        for name,stats in self.stats.items())
+
+    def __str__(self):
+        """Tabulate the statistics, slowest stages first."""
+        lines = ['{:40s} {:>8s} {:>10s} {:>10s} {:>10s} {:>8s} {:>12s}'.format(
+                'stage', 'calls', 'ms', 'self ms', 'read ms', 'reads',
+                'bytes')]
+        for name,stats in sorted(self.as_dict().items(),
+                                 key=lambda item: -item[1]['seconds']):
+            lines.append(
+                '{:40s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:8d} {:12d}'.format(
+                    name, stats['calls'], stats['seconds'] * 1e3,
+                    stats['self_seconds'] * 1e3,
+                    stats['read_seconds'] * 1e3, stats['reads'],
+                    stats['bytes']))
+        return '\n'.join(lines)
+
+
+class ProfilingStream (object):
+    """Charge the reads from a stream to the active profile's stages."""
+    def __init__(self, stream, profile):
+        self.stream = stream
+        self.profile = profile
+
+    def read(self, size=-1):
+        start = _timer()
+        data = self.stream.read(size)
+        self.profile.add_read(_timer() - start, len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@_contextlib.contextmanager
+def stage(name):
+    """Time a stage with the active profile, if there is one."""
+    p = ACTIVE
+    if p is None:
+        yield
+        return
+    with p.stage(name):
+        yield
+
+
+@_contextlib.contextmanager
+def profile(memory=False):
+    r"""Collect parsing statistics in a ``with`` block.
+
+    With ``memory=True`` allocations are also traced, using
+    ``tracemalloc``, which slows parsing down considerably.
+
+    >>> import io
+    >>> import numpy
+    >>> from igor.binarywave import load, save
+    >>> stream = io.BytesIO()
+    >>> save(stream, numpy.arange(1000, dtype=numpy.float64))
+    >>> _ = stream.seek(0)
+    >>> with profile(memory=True) as p:
+    ...     wave = load(stream)
+    >>> stats = p.as_dict()
+    >>> stats['Wave']['calls'], stats['Wave.version']['bytes']
+    (1, 2)
+    >>> stats['Wave5.wData']['bytes'], stats['Wave5.wData']['reads']
+    (8000, 1)
+    >>> stats['Wave5.wData']['allocated'] >= 8000
+    True
+    >>> stats['Wave.version:post_unpack']['calls']
+    1
+    >>> ACTIVE is None
+    True
+    """
+    global ACTIVE
+    p = Profile(memory=memory)
+    started_tracemalloc = False
+    if memory:
+        if _tracemalloc is None:
+            raise ImportError('profile(memory=True) requires tracemalloc '
+                              '(Python >= 3.4)')
+        if not _tracemalloc.is_tracing():
+            _tracemalloc.start()
+            started_tracemalloc = True
+    previous = ACTIVE
+    ACTIVE = p
+    try:
+        yield p
+    finally:
+        ACTIVE = previous
+        if started_tracemalloc:
+            _tracemalloc.stop()
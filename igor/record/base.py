@@ -15,13 +15,30 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with igor.  If not, see <http://www.gnu.org/licenses/>.
 
+import re as _re
+
+from ..util import BufferStream as _BufferStream
+
+
+_NEWLINE_REGEXP = _re.compile(b'\r\n?')
+
 
 class Record (object):
+    """A packed experiment record.
+
+    ``data`` is the record's payload, as ``bytes`` or any other buffer
+    (e.g. a ``memoryview`` into a memory-mapped file, see
+    ``packed.load(mmap=True)``).
+    """
     def __init__(self, header, data, byte_order=None):
         self.header = header
         self.data = data
         self.byte_order = byte_order
 
+    def _stream(self):
+        """Return a stream over ``.data`` whose reads do not copy."""
+        return _BufferStream(memoryview(self.data))
+
     def __str__(self):
         return self.__repr__()
 
@@ -42,6 +59,13 @@ class UnusedRecord (Record):
 class TextRecord (Record):
     def __init__(self, *args, **kwargs):
         super(TextRecord, self).__init__(*args, **kwargs)
-        self.text = bytes(self.data).replace(
-            b'\r\n', b'\n').replace(b'\r', b'\n')
-        self.null_terminated_text = self.text.split(b'\x00', 1)[0]
+        text = self.data
+        if not isinstance(text, bytes):
+            text = bytes(text)
+        if b'\r' in text:
+            text = _NEWLINE_REGEXP.sub(b'\n', text)
+        self.text = text
+        end = text.find(b'\x00')
+        if end >= 0:
+            text = text[:end]
+        self.null_terminated_text = text
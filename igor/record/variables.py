@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with igor.  If not, see <http://www.gnu.org/licenses/>.
 
-import io as _io
+import struct as _struct
+
+import numpy as _numpy
 
 from .. import LOG as _LOG
 from ..binarywave import TYPE_TABLE as _TYPE_TABLE
@@ -26,6 +28,7 @@ from ..struct import DynamicStructure as _DynamicStructure
 from ..struct import Field as _Field
 from ..struct import DynamicField as _DynamicField
 from ..util import byte_order as _byte_order
+from ..util import _bytes
 from ..util import need_to_reorder_bytes as _need_to_reorder_bytes
 from .base import Record
 
@@ -258,6 +261,10 @@ Variables2 = _DynamicStructure(
 
 
 class DynamicVersionField (_DynamicField):
+    def __init__(self, *args, **kwargs):
+        self.structures = kwargs.pop('structures', {})
+        super(DynamicVersionField, self).__init__(*args, **kwargs)
+
     def pre_pack(self, parents, byte_order):
         raise NotImplementedError()
 
@@ -270,23 +277,22 @@ class DynamicVersionField (_DynamicField):
             need_to_reorder_bytes = _need_to_reorder_bytes(version)
             variables_structure.byte_order = _byte_order(need_to_reorder_bytes)
             _LOG.debug(
-                'get byte order from version: {} (reorder? {})'.format(
-                    variables_structure.byte_order, need_to_reorder_bytes))
+                'get byte order from version: %s (reorder? %s)',
+                variables_structure.byte_order, need_to_reorder_bytes)
         else:
             need_to_reorder_bytes = False
 
         old_format = variables_structure.fields[-1].format
-        if version == 1:
-            variables_structure.fields[-1].format = Variables1
-        elif version == 2:
-            variables_structure.fields[-1].format = Variables2
+        structure = self.structures.get(version, None)
+        if structure is not None:
+            variables_structure.fields[-1].format = structure
         elif not need_to_reorder_bytes:
             raise ValueError(
                 'invalid variables record version: {}'.format(version))
 
         if variables_structure.fields[-1].format != old_format:
-            _LOG.debug('change variables record from {} to {}'.format(
-                    old_format, variables_structure.fields[-1].format))
+            _LOG.debug('change variables record from %s to %s',
+                       old_format, variables_structure.fields[-1].format)
             variables_structure.setup()
         elif need_to_reorder_bytes:
             variables_structure.setup()
@@ -298,7 +304,7 @@ class DynamicVersionField (_DynamicField):
 VariablesRecordStructure = _DynamicStructure(
     name='VariablesRecord',
     fields=[
-        DynamicVersionField('h', 'version', help='Version number for this header.'),
+        DynamicVersionField('h', 'version', help='Version number for this header.', structures={1: Variables1, 2: Variables2}),
         _Field(Variables1, 'variables', help='The rest of the variables data.'),
         ])
 
@@ -307,13 +313,50 @@ class VariablesRecord (Record):
     def __init__(self, *args, **kwargs):
         super(VariablesRecord, self).__init__(*args, **kwargs)
         # self.header['version']  # record version always 0?
-        VariablesRecordStructure.byte_order = '='
-        VariablesRecordStructure.setup()
-        stream = _io.BytesIO(bytes(self.data))
-        self.variables = VariablesRecordStructure.unpack_stream(stream)
+        stream = self._stream()
+        with VariablesRecordStructure.parse_context() as structure:
+            structure.byte_order = '='
+            structure.setup()
+            self.variables = structure.unpack_stream(stream)
         self.namespace = {}
         for key,value in self.variables['variables'].items():
             if key not in ['var_header']:
-                _LOG.debug('update namespace {} with {} for {}'.format(
-                        self.namespace, value, key))
+                _LOG.debug('update namespace %s with %s for %s',
+                           self.namespace, value, key)
                 self.namespace.update(value)
+
+
+def pack_variables(namespace, sys_vars=(), byte_order='='):
+    """Pack variables into the data for a (version 1) variables record.
+
+    The inverse of ``VariablesRecord``.  ``namespace`` maps names to
+    values: ``bytes`` are saved as string variables and numbers as
+    numeric variables (complex if they have an imaginary part).
+    ``sys_vars`` lists the values of the system variables K0, K1, ...,
+    which are only used in the root data folder.
+    """
+    numeric = []
+    strings = []
+    for name,value in namespace.items():
+        name = _bytes(name)
+        if len(name) > 31:
+            raise ValueError(
+                'variable name {!r} longer than 31 characters'.format(name))
+        if isinstance(value, (bytes, str)):
+            value = _bytes(value)
+            if len(value) > 2**15 - 1:
+                raise ValueError(
+                    'string variable {!r} too long ({} bytes)'.format(
+                        name, len(value)))
+            strings.append(_struct.pack(
+                    byte_order + '32sh', name, len(value)) + value)
+        else:
+            value = complex(value)
+            num_type = 5 if value.imag else 4  # NT_CMPLX | NT_FP64, NT_FP64
+            numeric.append(_struct.pack(
+                    byte_order + '32shhddl', name, 1, num_type,
+                    value.real, value.imag, 0))
+    header = _struct.pack(
+        byte_order + '4h', 1, len(sys_vars), len(numeric), len(strings))
+    sys_vars = _numpy.asarray(sys_vars, dtype=byte_order + 'f4').tobytes()
+    return b''.join([header, sys_vars] + numeric + strings)
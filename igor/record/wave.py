@@ -15,16 +15,63 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with igor.  If not, see <http://www.gnu.org/licenses/>.
 
-from io import BytesIO as _BytesIO
-
+from .. import LOG as _LOG
 from ..binarywave import load as _loadibw
+from ..binarywave import load_header as _loadibw_header
 from . import Record
 
 
 class WaveRecord (Record):
+    """Packed experiment record holding an IGOR binary wave.
+
+    By default the wave is decoded when the record is created.  With
+    ``lazy=True`` it is decoded from ``.data`` on the first ``.wave``
+    access and kept until ``.evict()`` drops it again, while ``.name``
+    only needs the wave headers.
+    """
     def __init__(self, *args, **kwargs):
+        lazy = kwargs.pop('lazy', False)
         super(WaveRecord, self).__init__(*args, **kwargs)
-        self.wave = _loadibw(_BytesIO(bytes(self.data)))
+        self._wave = None
+        self._headers = None
+        if not lazy:
+            self._wave = self._load()
+
+    def _load(self):
+        _LOG.debug('decoding the wave in %r', self)
+        return _loadibw(self._stream())
+
+    @property
+    def wave(self):
+        if self._wave is None:
+            self._wave = self._load()
+        return self._wave
+
+    @property
+    def headers(self):
+        """The wave's headers, as ``binarywave.load_header`` returns them.
+
+        Only the headers are parsed, even for a lazy record.
+        """
+        if self._headers is None:
+            self._headers = _loadibw_header(self._stream())
+        return self._headers
+
+    @property
+    def name(self):
+        "The wave's name (``bname``), peeked from the wave header."
+        if self._wave is not None:
+            headers = self._wave
+        else:
+            headers = self.headers
+        return headers['wave']['wave_header']['bname']
+
+    def evict(self):
+        """Drop the decoded wave to free its memory.
+
+        The next ``.wave`` access decodes it again from ``.data``.
+        """
+        self._wave = None
 
     def __str__(self):
         return str(self.wave)
@@ -57,7 +57,8 @@ class Script (object):
     def run(self, *args, **kwargs):
         args = self.parser.parse_args(*args, **kwargs)
         if args.infile == '-':
-            args.infile = _sys.stdin
+            # read bytes, not text, from Python 3's stdin
+            args.infile = getattr(_sys.stdin, 'buffer', _sys.stdin)
         if args.outfile == '-':
             args.outfile = _sys.stdout
         if args.verbose > 1:
@@ -24,14 +24,233 @@ with each field in a hierarchy of Python dictionaries.
 """
 
 from __future__ import absolute_import
+import contextlib as _contextlib
+import copy as _copy
 import io as _io
 import logging as _logging
 import pprint as _pprint
 import struct as _struct
+import threading as _threading
 
 import numpy as _numpy
 
 from . import LOG as _LOG
+from . import profiling as _profiling
+
+
+_STRUCT_CACHE = {}
+_STRUCT_CACHE_SIZE = 1024
+
+# free private copies of shared structures, see Structure.parse_context
+_PARSE_COPIES = {}
+_PARSE_COPIES_LOCK = _threading.Lock()
+
+
+def _repeat_format(format, count):
+    """Return a ``struct`` format for ``count`` repeats of ``format``.
+
+    >>> _repeat_format('h', 3)
+    '3h'
+    >>> _repeat_format('s', 3)
+    'sss'
+    >>> _repeat_format('c', 1)
+    'c'
+    >>> _repeat_format('f', 0)
+    ''
+    """
+    if count == 1:
+        return format
+    elif count == 0:
+        return ''  # a bare '0i' would still align
+    elif format in 'sp':  # repeat counts give these a length
+        return format * count
+    return '{}{}'.format(count, format)
+
+
+def _get_struct(byte_order, formats):
+    """Return a cached ``struct.Struct`` for a sequence of fields.
+
+    ``formats`` is a tuple of ``(format, count)`` pairs for
+    consecutive non-structure fields, so the cache is keyed on the
+    byte order and the current (possibly dynamic) counts.
+
+    >>> _get_struct('>', (('h', 1), ('P', 2), ('x', 4))).format
+    '>h2I4x'
+    >>> _get_struct('>', (('h', 1), ('P', 2), ('x', 4))) is _get_struct(
+    ...     '>', (('h', 1), ('P', 2), ('x', 4)))
+    True
+    """
+    key = (byte_order, formats)
+    try:
+        return _STRUCT_CACHE[key]
+    except KeyError:
+        pass
+    format = byte_order + ''.join(
+        _repeat_format(fmt, count) for fmt,count in formats)
+    # P format only allowed for native byte ordering
+    # Convert P to I for ILP32 compatibility when running on a LP64.
+    format = format.replace('P', 'I')
+    struct = _struct.Struct(format)
+    if len(_STRUCT_CACHE) >= _STRUCT_CACHE_SIZE:
+        _STRUCT_CACHE.clear()
+    _STRUCT_CACHE[key] = struct
+    return struct
+
+
+_DTYPE_CACHE = {}
+
+# numpy kinds for the ``struct`` formats (sizes come from ``calcsize``)
+_DTYPE_KINDS = {
+    '?': 'b',
+    'b': 'i', 'B': 'u',
+    'h': 'i', 'H': 'u',
+    'i': 'i', 'I': 'u',
+    'l': 'i', 'L': 'u',
+    'q': 'i', 'Q': 'u',
+    'P': 'u',
+    'e': 'f', 'f': 'f', 'd': 'f',
+    }
+
+# dtypes ``numpy.array`` picks for lists of the unpacked Python values
+_ARRAY_DTYPES = {
+    'b': _numpy.bool_,
+    'i': _numpy.int_,
+    'u': _numpy.int_,
+    'f': _numpy.float64,
+    }
+
+
+def _get_dtype(byte_order, fields):
+    """Return a cached structured ``numpy.dtype`` for a sequence of fields.
+
+    The dtype has the same layout as the ``struct`` format for
+    ``byte_order``, with one entry per field holding data (padding
+    and zero-count fields only take up space).  Returns ``None`` for
+    layouts ``_unpack_record`` would not decode exactly like
+    ``Field.unpack_data`` (fields with custom unpacking, ``p``
+    strings, nested structures with native alignment, ...), so the
+    caller can fall back to ``struct``.
+
+    >>> run = Structure('run', fields=[
+    ...     Field('I', 'time'),
+    ...     Field('x', 'padding', count=2, array=True),
+    ...     Field('h', 'data', count=(2,3), array=True)])
+    >>> dtype = _get_dtype('>', run.fields)
+    >>> [(name, dtype.fields[name][1]) for name in dtype.names]
+    [('time', 0), ('data', 6)]
+    >>> dtype.itemsize == _struct.calcsize('>I2x6h')
+    True
+    """
+    key = (byte_order, tuple(
+            (f, f.format, getattr(f.format, 'format', None), f.count)
+            for f in fields))
+    try:
+        return _DTYPE_CACHE[key]
+    except KeyError:
+        pass
+    numpy_byte_order = {'@': '=', '!': '>'}.get(byte_order, byte_order)
+    names = []
+    formats = []
+    offsets = []
+    prefix = ''
+    offset = 0
+    dtype = None
+    for f in fields:
+        if type(f) is not Field:
+            break  # may override unpack_data
+        if isinstance(f.format, Structure):
+            if (byte_order == '@' or _numpy.ndim(f.count) or
+                    not f.arg_count):
+                break
+            base = _get_dtype(byte_order, f.format.fields)
+            if base is None:
+                break
+            format = ''.join(f.format.sub_format()).replace('P', 'I')
+        elif f.format in _DTYPE_KINDS or f.format in 'csx':
+            format = f.format.replace('P', 'I')
+            size = _struct.calcsize(byte_order + format)
+            if f.format in _DTYPE_KINDS:
+                base = '{}{}{}'.format(
+                    numpy_byte_order, _DTYPE_KINDS[f.format], size)
+            elif f.array:
+                base = 'S1'
+            else:
+                base = 'V1'  # 'S1' would drop a null byte
+        else:
+            break
+        if byte_order == '@':  # account for native alignment
+            offset = _struct.calcsize(
+                byte_order + prefix + _repeat_format(format, 1)
+                ) - _struct.calcsize(byte_order + format)
+        if isinstance(f.format, Structure):
+            format *= f.item_count
+        else:
+            format = _repeat_format(format, f.item_count)
+        if f.arg_count:
+            names.append(f.name)
+            if f.array:
+                # a shape tuple, since (base, 1) would give a scalar
+                formats.append((base, tuple(_numpy.atleast_1d(f.count))))
+            else:
+                formats.append(base)
+            offsets.append(offset)
+        elif not f.array:
+            break
+        prefix += format
+        offset += _struct.calcsize(byte_order + format)
+    else:
+        dtype = _numpy.dtype({
+                'names': names,
+                'formats': formats,
+                'offsets': offsets,
+                'itemsize': _struct.calcsize(byte_order + prefix),
+                })
+    if len(_DTYPE_CACHE) >= _STRUCT_CACHE_SIZE:
+        _DTYPE_CACHE.clear()
+    _DTYPE_CACHE[key] = dtype
+    return dtype
+
+
+def _has_arrays(fields):
+    """Return ``True`` if ``numpy`` beats ``struct`` for ``fields``.
+
+    ``struct`` is faster for a handful of scalars, but array fields
+    otherwise go through a Python list and ``numpy.array``.
+    """
+    for f in fields:
+        if f.array or isinstance(f.format, Structure):
+            return True
+    return False
+
+
+def _unpack_record(fields, values):
+    """Convert ``numpy.void.item()`` output into a dict of field data.
+
+    ``values`` are the items of a record with a ``_get_dtype(...,
+    fields)`` dtype.  The result matches what ``Field.unpack_data``
+    returns for the same bytes unpacked with ``struct``.
+    """
+    data = {}
+    values = iter(values)
+    for f in fields:
+        if not f.arg_count:
+            data[f.name] = _numpy.array([])  # padding bytes, etc.
+            continue
+        value = next(values)
+        if isinstance(f.format, Structure):
+            if f.array:
+                value = [_unpack_record(f.format.fields, v.item())
+                         for v in value]
+            else:
+                value = _unpack_record(f.format.fields, value)
+        elif f.array:
+            if value.dtype.kind == 'u' and value.dtype.itemsize >= 8:
+                value = _numpy.array(value.tolist())  # may overflow int_
+            else:
+                value = value.astype(
+                    _ARRAY_DTYPES.get(value.dtype.kind, value.dtype))
+        data[f.name] = value
+    return data
 
 
 class Field (object):
@@ -164,7 +383,7 @@ class Field (object):
         Use this method to recalculate dynamic properities after
         changing the basic properties set during initialization.
         """
-        _LOG.debug('setup {}'.format(self))
+        _LOG.debug('setup %s', self)
         self.item_count = _numpy.prod(self.count)  # number of item repeats
         if not self.array and self.item_count != 1:
             raise ValueError(
@@ -255,25 +474,19 @@ class Field (object):
 
     def unpack_data(self, data):
         """Inverse of .pack_data"""
-        _LOG.debug('unpack {} for {} {}'.format(data, self, self.format))
-        iterator = iter(data)
-        try:
-            items = [next(iterator) for i in range(self.arg_count)]
-        except StopIteration:
+        _LOG.debug('unpack %s for %s %s', data, self, self.format)
+        items = list(data)
+        if len(items) < self.arg_count:
             raise ValueError('not enough data to unpack {}'.format(self))
-        try:
-            next(iterator)
-        except StopIteration:
-            pass
-        else:
+        elif len(items) > self.arg_count:
             raise ValueError('too much data to unpack {}'.format(self))
         if isinstance(self.format, Structure):
             # break into per-structure clumps
             s = self.structure_count
             items = zip(*[items[i::s] for i in range(s)])
+            unpacked = [self.unpack_item(i) for i in items]
         else:
-            items = [[i] for i in items]
-        unpacked = [self.unpack_item(i) for i in items]
+            unpacked = items  # .unpack_item([x]) is just x
         if self.arg_count:
             count = self.count
         else:
@@ -290,8 +503,8 @@ class Field (object):
                 raise NotImplementedError('reshape Structure field')
         else:
             unpacked = _numpy.array(unpacked)
-            _LOG.debug('reshape {} data from {} to {}'.format(
-                    self, unpacked.shape, count))
+            _LOG.debug('reshape %s data from %s to %s',
+                       self, unpacked.shape, count)
             unpacked = unpacked.reshape(count)
         return unpacked
 
@@ -395,11 +608,11 @@ class Structure (_struct.Struct):
     The structures automatically calculate the flattened data format:
 
     >>> run.format
-    '@Ihhhhhh'
+    '@I6h'
     >>> run.size  # 4 + 2*3*2
     16
     >>> experiment.format
-    '@HIhhhhhhIhhhhhh'
+    '@HI6hI6h'
     >>> experiment.size  # 2 + 2 + 2*(4 + 2*3*2)
     36
 
@@ -411,10 +624,20 @@ class Structure (_struct.Struct):
 
     >>> experiment.set_byte_order('>')
     >>> experiment.get_format()
-    '>HIhhhhhhIhhhhhh'
+    '>HI6hI6h'
     >>> experiment.size
     34
 
+    The same layout is available as a numpy structured dtype, which
+    ``unpack`` and ``unpack_from`` use to decode array fields in a
+    single pass:
+
+    >>> dtype = experiment.get_dtype()
+    >>> dtype.names
+    ('version', 'runs')
+    >>> dtype.itemsize
+    34
+
     You can read data out of any object supporting the buffer
     interface:
 
@@ -464,7 +687,7 @@ class Structure (_struct.Struct):
     ...     version, Field('f', 'ignored', count=0, array=True), runs],
     ...     byte_order='>')
     >>> experiment2.format
-    '>HIhhhhhhIhhhhhh'
+    '>HI6hI6h'
     >>> d = experiment2.unpack(b)
     >>> pprint(d)
     {'ignored': array([], dtype=float64),
@@ -496,20 +719,63 @@ class Structure (_struct.Struct):
         return '<{} {} {}>'.format(
             self.__class__.__name__, self.name, id(self))
 
+    def __deepcopy__(self, memo):
+        structure = self.__class__(
+            name=self.name, fields=_copy.deepcopy(self.fields, memo),
+            byte_order=self.byte_order)
+        memo[id(self)] = structure
+        return structure
+
+    @_contextlib.contextmanager
+    def parse_context(self):
+        """Lend out a private copy of the structure for one parse.
+
+        Dynamic structures keep per-parse state (the byte order,
+        counts and shapes set by hooks, swapped version-specific
+        sub-structures, ...) on their structures and fields, so a
+        shared module-level structure can only parse one buffer at a
+        time.  The copies yielded here are deep copies, returned to a
+        pool when the block exits, so concurrent (or nested) parses
+        in different threads never share state:
+
+        >>> version = Field('H', 'version', help='example version')
+        >>> header = Structure('header', fields=[version], byte_order='>')
+        >>> with header.parse_context() as h:
+        ...     h.byte_order = '<'
+        ...     h.setup()
+        ...     h.unpack(b'\\x01\\x00')
+        {'version': 1}
+        >>> header.byte_order
+        '>'
+        >>> with header.parse_context() as h2:
+        ...     h2 is h
+        True
+        """
+        with _PARSE_COPIES_LOCK:
+            free = _PARSE_COPIES.setdefault(self, [])
+            structure = free.pop() if free else None
+        if structure is None:
+            structure = _copy.deepcopy(self)
+        try:
+            yield structure
+        finally:
+            with _PARSE_COPIES_LOCK:
+                free.append(structure)
+
     def setup(self):
         """Setup any dynamic properties of a structure.
 
         Use this method to recalculate dynamic properities after
         changing the basic properties set during initialization.
         """
-        _LOG.debug('setup {!r}'.format(self))
+        _LOG.debug('setup %r', self)
         self.set_byte_order(self.byte_order)
         self.get_format()
 
     def set_byte_order(self, byte_order):
         """Allow changing the format byte_order on the fly.
         """
-        _LOG.debug('set byte order for {!r} to {}'.format(self, byte_order))
+        _LOG.debug('set byte order for %r to %s', self, byte_order)
         self.byte_order = byte_order
         for field in self.fields:
             if isinstance(field.format, Structure):
@@ -524,19 +790,36 @@ class Structure (_struct.Struct):
             super(Structure, self).__init__(format=format)
         except _struct.error as e:
             raise ValueError((e, format))
+        # ``.format`` is ``bytes`` on Python < 3.7, so remember the
+        # compiled byte order instead of slicing it
+        self._format_byte_order = self.byte_order
         return format
 
     def sub_format(self):
-        _LOG.debug('calculate sub-format for {!r}'.format(self))
+        _LOG.debug('calculate sub-format for %r', self)
         for field in self.fields:
             if isinstance(field.format, Structure):
                 field_format = list(
                     field.format.sub_format()) * field.item_count
             else:
-                field_format = [field.format]*field.item_count
+                field_format = [_repeat_format(field.format, field.item_count)]
             for fmt in field_format:
                 yield fmt
 
+    def _use_byte_order(self, byte_order):
+        """Make sure the structure is set up for ``byte_order``.
+
+        Unlike ``setup``, this skips recalculating the format when the
+        compiled format already uses ``byte_order``.  Nested structures
+        only have their ``byte_order`` attribute updated by
+        ``set_byte_order``, so their compiled format is checked when
+        they are used.
+        """
+        if (self.byte_order != byte_order or
+                self._format_byte_order != byte_order):
+            self.set_byte_order(byte_order)
+            self.get_format()
+
     def _pack_item(self, item=None):
         """Linearize a single count of the structure's data to a flat iterable
         """
@@ -555,19 +838,16 @@ class Structure (_struct.Struct):
     def _unpack_item(self, args):
         """Inverse of ._unpack_item"""
         data = {}
-        iterator = iter(args)
+        args = tuple(args)
+        start = 0
         for f in self.fields:
-            try:
-                items = [next(iterator) for i in range(f.arg_count)]
-            except StopIteration:
+            end = start + f.arg_count
+            if end > len(args):
                 raise ValueError('not enough data to unpack {}.{}'.format(
                         self, f))
-            data[f.name] = f.unpack_data(items)
-        try:
-            next(iterator)
-        except StopIteration:
-            pass
-        else:
+            data[f.name] = f.unpack_data(args[start:end])
+            start = end
+        if start < len(args):
             raise ValueError('too much data to unpack {}'.format(self))
         return data
 
@@ -583,14 +863,52 @@ class Structure (_struct.Struct):
         return super(Structure, self).pack_into(
             buffer, offset, *args)
 
+    def get_dtype(self):
+        """Return a structured ``numpy.dtype`` matching ``.format``.
+
+        Raises ``ValueError`` if the fields cannot be represented (see
+        ``_get_dtype``), in which case unpacking uses ``struct``.
+        """
+        dtype = _get_dtype(self.byte_order, self.fields)
+        if dtype is None:
+            raise ValueError('no numpy dtype for {!r}'.format(self))
+        return dtype
+
+    def _unpack_dtype(self, buffer, offset=0):
+        """Unpack with a single ``numpy.frombuffer`` call.
+
+        Returns ``None`` if the fields have no arrays or no dtype, or
+        if the buffer is too short, so ``struct`` can take over (and
+        raise its usual errors).
+        """
+        if not _has_arrays(self.fields):
+            return None
+        dtype = _get_dtype(self.byte_order, self.fields)
+        if dtype is None:
+            return None
+        try:
+            record = _numpy.frombuffer(
+                buffer, dtype=dtype, count=1, offset=offset)
+        except ValueError:
+            return None
+        return _unpack_record(self.fields, record.item())
+
     def unpack(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and len(args[0]) == self.size:
+            data = self._unpack_dtype(args[0])
+            if data is not None:
+                return data
         args = super(Structure, self).unpack(*args, **kwargs)
         return self._unpack_item(args)
 
     def unpack_from(self, buffer, offset=0, *args, **kwargs):
         _LOG.debug(
-            'unpack {!r} for {!r} ({}, offset={}) with {} ({})'.format(
-                buffer, self, len(buffer), offset, self.format, self.size))
+            'unpack %r for %r (%s, offset=%s) with %s (%s)',
+            buffer, self, len(buffer), offset, self.format, self.size)
+        if not args and not kwargs:
+            data = self._unpack_dtype(buffer, offset)
+            if data is not None:
+                return data
         args = super(Structure, self).unpack_from(
             buffer, offset, *args, **kwargs)
         return self._unpack_item(args)
@@ -605,11 +923,81 @@ class DebuggingStream (object):
 
     def read(self, size):
         data = self.stream.read(size)
-        _LOG.debug('read {} from {}: ({}) {!r}'.format(
-                size, self.stream, len(data), data))
+        _LOG.debug('read %s from %s: (%s) %r',
+                   size, self.stream, len(data), data)
         return data
 
 
+def _get_hook(field, name):
+    """Return the bound ``name`` hook of ``field``.
+
+    Returns ``None`` if the field has no such hook or only inherits
+    the no-op from ``DynamicField``.
+    """
+    hook = getattr(field, name, None)
+    if getattr(hook, '__func__', None) is DynamicField.__dict__[name]:
+        return None
+    return hook
+
+
+class _FieldRun (object):
+    """Consecutive plain fields unpacked with a single struct.
+
+    Plain fields have no hooks and a non-structure format, so nothing
+    can change between reading one and the next.
+    """
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+
+
+class _FieldStep (object):
+    """A field unpacked on its own, with its hooks looked up once."""
+    def __init__(self, field):
+        self.field = field
+        self.pre_unpack = _get_hook(field, 'pre_unpack')
+        self.unpack = getattr(field, 'unpack', None)
+        self.post_unpack = _get_hook(field, 'post_unpack')
+
+
+class _ProfiledStep (object):
+    """A ``_FieldStep`` whose hooks are timed by a profile."""
+    def __init__(self, step, profile, name):
+        self.field = step.field
+        self.unpack = step.unpack
+        self.pre_unpack = self._wrap(
+            step.pre_unpack, profile, name + ':pre_unpack')
+        self.post_unpack = self._wrap(
+            step.post_unpack, profile, name + ':post_unpack')
+
+    @staticmethod
+    def _wrap(hook, profile, name):
+        if hook is None:
+            return None
+        def wrapped(*args, **kwargs):
+            with profile.stage(name):
+                return hook(*args, **kwargs)
+        return wrapped
+
+
+def _compile_plan(fields):
+    """Compile the unpacking plan for a ``DynamicStructure``'s fields.
+    """
+    plan = []
+    run = []
+    for field in fields:
+        if (type(field) is Field and
+                not isinstance(field.format, Structure)):
+            run.append(field)
+            continue
+        if run:
+            plan.append(_FieldRun(run))
+            run = []
+        plan.append(_FieldStep(field))
+    if run:
+        plan.append(_FieldRun(run))
+    return plan
+
+
 class DynamicStructure (Structure):
     r"""Represent a C structure field with a dynamic definition.
 
@@ -688,6 +1076,14 @@ class DynamicStructure (Structure):
     >>> pprint(d)
     {'data': array([258, 772]), 'length': 2}
 
+    Length-one arrays are still arrays:
+
+    >>> b = b'\x00\x00\x00\x01\x01\x02'
+    >>> pprint(dynamic_length_vector.unpack(b))
+    {'data': array([258]), 'length': 1}
+    >>> pprint(dynamic_data_vector.unpack(b))
+    {'data': array([258]), 'length': 1}
+
     >>> d['data'] = [1,2,3,4]
     >>> dynamic_length_vector.pack(d)
     '\x00\x00\x00\x04\x00\x01\x00\x02\x00\x03\x00\x04'
@@ -708,10 +1104,10 @@ class DynamicStructure (Structure):
             parents = parents + [self]
         for f in self.fields:
             if hasattr(f, 'pre_pack'):
-                _LOG.debug('pre-pack {}'.format(f))
+                _LOG.debug('pre-pack %s', f)
                 f.pre_pack(parents=parents, data=data)
             if isinstance(f.format, DynamicStructure):
-                _LOG.debug('pre-pack {!r}'.format(f.format))
+                _LOG.debug('pre-pack %r', f.format)
                 f._pre_pack(parents=parents, data=data)
 
     def pack(self, data):
@@ -725,106 +1121,171 @@ class DynamicStructure (Structure):
         return super(DynamicStructure, self).pack_into(
             buffer=buffer, offset=offset, data=data)
 
+    def _get_plan(self):
+        """Return the unpacking plan for the current fields.
+
+        The plan is compiled once and reused until ``fields`` changes.
+        It groups plain fields into runs decoded with one cached
+        ``struct.Struct`` (see ``_get_struct``) and records which hooks
+        the other fields override, so ``unpack_stream`` does not have
+        to rebuild formats or probe for hooks on every call.
+        """
+        fields = tuple(self.fields)
+        plan = getattr(self, '_plan', None)
+        if plan is None or plan[0] != fields:
+            plan = self._plan = (fields, _compile_plan(fields))
+        return plan[1]
+
     def unpack_stream(self, stream, parents=None, data=None, d=None):
         # `d` is the working data directory
+        profile = _profiling.ACTIVE
         if data is None:
             parents = [self]
             data = d = {}
-            if _LOG.level <= _logging.DEBUG:
+            if _LOG.isEnabledFor(_logging.DEBUG):
                 stream = DebuggingStream(stream)
+            if profile is not None:
+                stream = _profiling.ProfilingStream(stream, profile)
         else:
             parents = parents + [self]
 
-        for f in self.fields:
-            _LOG.debug('parsing {!r}.{} (count={}, item_count={})'.format(
-                    self, f, f.count, f.item_count))
-            if _LOG.level <= _logging.DEBUG:
-                _LOG.debug('data:\n{}'.format(_pprint.pformat(data)))
-            if hasattr(f, 'pre_unpack'):
-                _LOG.debug('pre-unpack {}'.format(f))
-                f.pre_unpack(parents=parents, data=data)
-
-            if hasattr(f, 'unpack'):  # override default unpacking
-                _LOG.debug('override unpack for {}'.format(f))
-                d[f.name] = f.unpack(stream)
-                continue
+        if profile is None:
+            for step in self._get_plan():
+                self._unpack_step(stream, step, parents, data, d)
+            return data
+        with profile.stage(self.name):
+            for step in self._get_plan():
+                if isinstance(step, _FieldRun):
+                    name = '{}.{}'.format(self.name, step.fields[0].name)
+                    if len(step.fields) > 1:
+                        name += '..{}'.format(step.fields[-1].name)
+                else:
+                    name = '{}.{}'.format(self.name, step.field.name)
+                    step = _ProfiledStep(step, profile, name)
+                with profile.stage(name):
+                    self._unpack_step(stream, step, parents, data, d)
+        return data
 
-            # setup for unpacking loop
-            if isinstance(f.format, Structure):
-                f.format.set_byte_order(self.byte_order)
-                f.setup()
-                f.format.setup()
-                if isinstance(f.format, DynamicStructure):
-                    if f.array:
-                        d[f.name] = []
-                        for i in range(f.item_count):
-                            x = {}
-                            d[f.name].append(x)
-                            f.format.unpack_stream(
-                                stream, parents=parents, data=data, d=x)
-                    else:
-                        assert f.item_count == 1, (f, f.count)
-                        d[f.name] = {}
-                        f.format.unpack_stream(
-                            stream, parents=parents, data=data, d=d[f.name])
-                    if hasattr(f, 'post_unpack'):
-                        _LOG.debug('post-unpack {}'.format(f))
-                        repeat = f.post_unpack(parents=parents, data=data)
-                        if repeat:
-                            raise NotImplementedError(
-                                'cannot repeat unpack for dynamic structures')
-                    continue
-            if isinstance(f.format, Structure):
-                _LOG.debug('parsing {} bytes for {}'.format(
-                        f.format.size, f.format.format))
-                bs = [stream.read(f.format.size) for i in range(f.item_count)]
-                def unpack():
-                    f.format.set_byte_order(self.byte_order)
-                    f.setup()
-                    f.format.setup()
-                    x = [f.format.unpack_from(b) for b in bs]
-                    if not f.array:
-                        assert len(x) == 1, (f, f.count, x)
-                        x = x[0]
-                    return x
+    def _unpack_step(self, stream, step, parents, data, d):
+        "Unpack the fields for one step of the plan into ``d``."
+        if isinstance(step, _FieldRun):
+            self._unpack_run(stream, step, d)
+            return
+        f = step.field
+        if _LOG.isEnabledFor(_logging.DEBUG):
+            _LOG.debug('parsing %r.%s (count=%s, item_count=%s)',
+                       self, f, f.count, f.item_count)
+            _LOG.debug('data:\n%s', _pprint.pformat(data))
+        if step.pre_unpack is not None:
+            _LOG.debug('pre-unpack %s', f)
+            step.pre_unpack(parents=parents, data=data)
+
+        if step.unpack is not None:  # override default unpacking
+            _LOG.debug('override unpack for %s', f)
+            d[f.name] = step.unpack(stream)
+            return
+
+        # setup for unpacking loop
+        if isinstance(f.format, DynamicStructure):
+            f.format._use_byte_order(self.byte_order)
+            if f.array:
+                d[f.name] = []
+                for i in range(f.item_count):
+                    x = {}
+                    d[f.name].append(x)
+                    f.format.unpack_stream(
+                        stream, parents=parents, data=data, d=x)
             else:
-                field_format = self.byte_order + f.format*f.item_count
-                field_format = field_format.replace('P', 'I')
-                try:
-                    size = _struct.calcsize(field_format)
-                except _struct.error as e:
-                    _LOG.error(e)
-                    _LOG.error('{}.{}: {}'.format(self, f, field_format))
-                    raise
-                _LOG.debug('parsing {} bytes for preliminary {}'.format(
-                        size, field_format))
-                raw = stream.read(size)
-                if len(raw) < size:
-                    raise ValueError(
-                        'not enough data to unpack {}.{} ({} < {})'.format(
-                            self, f, len(raw), size))
-                def unpack():
-                    field_format = self.byte_order + f.format*f.item_count
-                    field_format = field_format.replace('P', 'I')
-                    _LOG.debug('parse previous bytes using {}'.format(
-                            field_format))
-                    struct = _struct.Struct(field_format)
-                    items = struct.unpack(raw)
-                    return f.unpack_data(items)
-
-            # unpacking loop
-            repeat = True
-            while repeat:
-                d[f.name] = unpack()
-                if hasattr(f, 'post_unpack'):
-                    _LOG.debug('post-unpack {}'.format(f))
-                    repeat = f.post_unpack(parents=parents, data=data)
-                else:
-                    repeat = False
+                assert f.item_count == 1, (f, f.count)
+                d[f.name] = {}
+                f.format.unpack_stream(
+                    stream, parents=parents, data=data, d=d[f.name])
+            if step.post_unpack is not None:
+                _LOG.debug('post-unpack %s', f)
+                repeat = step.post_unpack(parents=parents, data=data)
                 if repeat:
-                    _LOG.debug('repeat unpack for {}'.format(f))
+                    raise NotImplementedError(
+                        'cannot repeat unpack for dynamic structures')
+            return
+        if isinstance(f.format, Structure):
+            f.format._use_byte_order(self.byte_order)
+            _LOG.debug('parsing %s bytes for %s',
+                       f.format.size, f.format.format)
+            bs = [stream.read(f.format.size) for i in range(f.item_count)]
+            def unpack():
+                f.format._use_byte_order(self.byte_order)
+                x = [f.format.unpack_from(b) for b in bs]
+                if not f.array:
+                    assert len(x) == 1, (f, f.count, x)
+                    x = x[0]
+                return x
+        else:
+            struct = self._get_field_struct((f,))
+            size = struct.size
+            _LOG.debug('parsing %s bytes for preliminary %s',
+                       size, struct.format)
+            raw = stream.read(size)
+            if len(raw) < size:
+                raise ValueError(
+                    'not enough data to unpack {}.{} ({} < {})'.format(
+                        self, f, len(raw), size))
+            def unpack():
+                struct = self._get_field_struct((f,))
+                _LOG.debug('parse previous bytes using %s',
+                           struct.format)
+                items = struct.unpack(raw)
+                return f.unpack_data(items)
+
+        # unpacking loop
+        repeat = True
+        while repeat:
+            d[f.name] = unpack()
+            if step.post_unpack is not None:
+                _LOG.debug('post-unpack %s', f)
+                repeat = step.post_unpack(parents=parents, data=data)
+            else:
+                repeat = False
+            if repeat:
+                _LOG.debug('repeat unpack for %s', f)
 
-        return data
+    def _get_field_struct(self, fields):
+        formats = tuple((f.format, f.item_count) for f in fields)
+        try:
+            return _get_struct(self.byte_order, formats)
+        except _struct.error as e:
+            _LOG.error(e)
+            _LOG.error('{}.{}: {}'.format(self, fields, formats))
+            raise
+
+    def _unpack_run(self, stream, run, d):
+        if self.byte_order == '@':
+            # native alignment would pad between the fused fields
+            groups = [(f,) for f in run.fields]
+        else:
+            groups = [run.fields]
+        for fields in groups:
+            struct = self._get_field_struct(fields)
+            _LOG.debug('parsing %s bytes for %r.%s with %s',
+                       struct.size, self, fields, struct.format)
+            raw = stream.read(struct.size)
+            if len(raw) < struct.size:
+                raise ValueError(
+                    'not enough data to unpack {}.{} ({} < {})'.format(
+                        self, fields, len(raw), struct.size))
+            if _has_arrays(fields):
+                dtype = _get_dtype(self.byte_order, fields)
+            else:
+                dtype = None
+            if dtype is not None:
+                record = _numpy.frombuffer(raw, dtype=dtype, count=1)
+                d.update(_unpack_record(fields, record.item()))
+                continue
+            items = struct.unpack(raw)
+            start = 0
+            for f in fields:
+                end = start + f.arg_count
+                d[f.name] = f.unpack_data(items[start:end])
+                start = end
 
     def unpack(self, string):
         stream = _io.BytesIO(string)
@@ -100,16 +100,67 @@ def need_to_reorder_bytes(version):
 
 # From ReadWave.c
 def checksum(buffer, byte_order, oldcksum, numbytes):
-    x = _numpy.ndarray(
-        (numbytes/2,), # 2 bytes to a short -- ignore trailing odd byte
-        dtype=_numpy.dtype(byte_order+'h'),
-        buffer=buffer)
-    oldcksum += x.sum()
-    if oldcksum > 2**31:  # fake the C implementation's int rollover
-        oldcksum %= 2**32
-        if oldcksum > 2**31:
-            oldcksum -= 2**31
-    return oldcksum & 0xffff
+    r"""Sum the first ``numbytes`` of a buffer as 16-bit integers.
+
+    Only the low 16 bits of the sum matter, so there is no need to
+    emulate the C implementation's ``int`` rollover.  A trailing odd
+    byte is ignored.
+
+    >>> checksum(b'\x01\x00\x02\x00\xff', '<', 0, 5)
+    3
+    >>> checksum(b'\x01\x00\x02\x00', '>', 0, 4)
+    768
+    >>> checksum(b'\xff\x7f\xff\x7f', '<', 2, 4)
+    0
+    """
+    x = _numpy.frombuffer(
+        buffer, dtype=_numpy.dtype(byte_order+'h'), count=numbytes//2)
+    return (oldcksum + int(x.sum())) & 0xffff
+
+class BufferStream (object):
+    r"""Read-only stream over a buffer that does not copy on read.
+
+    ``read`` returns slices of the wrapped buffer instead of fresh
+    ``bytes``, so a stream over a ``numpy.memmap`` hands out views into
+    the mapped file.
+
+    >>> stream = BufferStream(memoryview(b'\x00\x01\x02\x03\x04'))
+    >>> stream.read(2).tolist()
+    [0, 1]
+    >>> stream.tell()
+    2
+    >>> stream.seek(-1, 2)
+    4
+    >>> stream.read().tolist()
+    [4]
+    >>> stream.read(3).tolist()
+    []
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self.position = max(start, end)
+        return self.buffer[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
 
 def _bytes(obj, encoding='utf-8'):
     """Convert bytes or strings into bytes
@@ -0,0 +1,422 @@
+# This file is part of igor.
+#
+# igor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# igor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with igor.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time loading synthetic IGOR binary waves and packed experiments.
+
+Synthetic binary waves are generated for every type in
+``igor.binarywave.TYPE_TABLE``, every version (1, 2, 3 and 5), both
+byte orders and each of the requested sizes.  Text waves are
+generated for version 5.  Each wave is timed with
+``igor.binarywave.load``.  A plain ``read`` of a float64 wave of each
+size gives a reference for the disk, and ``igor.binarywave.save`` is
+timed writing it back.  A float32 wave of each size with a large note
+(``--note-size``) is also loaded, with the ``igor`` logger at its
+default level, which catches parsing that builds debug messages even
+when debug logging is disabled.  Synthetic packed experiments with the
+requested numbers of wave records are timed with ``igor.packed.load``
+and ``igor.igorpy.load``, and with ``igor.igorpy.Folder.lookup`` of
+each wave in the experiments' flat root folders.  The command line
+scripts in ``bin`` are timed on a subset of the files.
+
+Each case runs in a fresh Python process, which reports the best of
+``--repeat`` times and its peak resident set size (RSS).  The results
+(with the throughput in MB/s and records/s, or for lookups in
+lookups/s and microseconds per lookup) can be saved as JSON, and
+compared with earlier results to spot regressions::
+
+    $ python test/benchmark.py --output before.json
+    $ python test/benchmark.py --compare before.json
+    $ python test/benchmark.py --sizes 1K,1M,1G --records 10,100000 \\
+    >     --types float32,int16 --versions 5 --byte-orders '<'
+
+The script has to be able to import ``igor``, so run it from the
+source directory (with ``PYTHONPATH=.``) or after installing the
+package.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # e.g. on Windows
+    resource = None
+
+import numpy
+
+import igor
+from igor.binarywave import TYPE_TABLE
+from igor.binarywave import load as loadibw
+from igor.binarywave import save as saveibw
+from igor.igorpy import load as loadigorpy
+from igor.packed import load as loadpxp
+from igor.packed import save as savepxp
+
+
+_BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'bin')
+
+# Keys that identify a case when comparing results.
+CASE_KEYS = ['benchmark', 'type', 'version', 'byte_order', 'size',
+             'note_size', 'records']
+
+SIZE_SUFFIXES = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+# Points in each wave of the synthetic packed experiments.
+PXP_WAVE_POINTS = 64
+
+
+def type_name(dtype):
+    """Name a ``TYPE_TABLE`` type, e.g. ``float32`` or ``complexint16``."""
+    dtype = numpy.dtype(dtype)
+    if dtype.names:
+        return 'complex{}'.format(dtype['real'].name)
+    return dtype.name
+
+
+# (key: type name, value: numpy dtype), for the types with data.  Type
+# 1 (NT_CMPLX) is only a flag, the same as 5 (NT_CMPLX | NT_FP64).
+TYPES = dict(
+    (type_name(type_), numpy.dtype(type_))
+    for code,type_ in sorted(TYPE_TABLE.items())
+    if type_ is not None and code != 1)
+
+
+def parse_size(size):
+    """Convert a size like ``64M`` into bytes.
+
+    >>> [parse_size(s) for s in ['512', '1K', '64M', '1G']]
+    [512, 1024, 67108864, 1073741824]
+    """
+    size = size.strip().upper()
+    suffix = size[-1:] if size[-1:] in SIZE_SUFFIXES else ''
+    return int(float(size[:len(size)-len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+
+def split(string, convert=str):
+    return [convert(x) for x in string.split(',') if x]
+
+
+def get_cases(args):
+    """List the cases selected by the command line arguments."""
+    cases = []
+    for size in args.sizes:
+        for benchmark in ['read', 'binarywave.save']:
+            cases.append({'benchmark': benchmark, 'type': 'float64',
+                          'version': 5, 'byte_order': '<', 'size': size})
+        if args.note_size:
+            cases.append({'benchmark': 'binarywave.load', 'type': 'float32',
+                          'version': 5, 'byte_order': '<', 'size': size,
+                          'note_size': args.note_size})
+        for type_ in args.types:
+            versions = [5] if type_ == 'text' else args.versions
+            for version in versions:
+                for byte_order in args.byte_orders:
+                    cases.append({
+                            'benchmark': 'binarywave.load', 'type': type_,
+                            'version': version, 'byte_order': byte_order,
+                            'size': size})
+        if size <= args.cli_max_size:
+            cases.append({
+                    'benchmark': 'bin/igorbinarywave.py', 'type': 'float64',
+                    'version': 5, 'byte_order': '<', 'size': size})
+    for records in args.records:
+        for benchmark in ['packed.load', 'igorpy.load', 'igorpy.lookup']:
+            cases.append({'benchmark': benchmark, 'records': records})
+        if records <= args.cli_max_records:
+            cases.append({'benchmark': 'bin/igorpackedexperiment.py',
+                          'records': records})
+    return cases
+
+
+def write_ibw(path, case):
+    """Write the synthetic binary wave for a case."""
+    if case['type'] == 'text':
+        # 16-byte strings
+        count = max(case['size'] // 16, 1)
+        data = numpy.array([b'x' * 15] * count)
+    else:
+        dtype = TYPES[case['type']]
+        data = numpy.zeros(max(case['size'] // dtype.itemsize, 1), dtype=dtype)
+    if case.get('note_size', None):
+        data = {'wave': {'wData': data, 'note': b'x' * case['note_size']}}
+    saveibw(path, data, version=case['version'],
+            byte_order=case['byte_order'])
+
+
+def write_pxp(path, case):
+    """Write the synthetic packed experiment for a case."""
+    data = numpy.arange(PXP_WAVE_POINTS, dtype=numpy.float64)
+    waves = dict(
+        ('wave{}'.format(i).encode('ascii'), data)
+        for i in range(case['records']))
+    savepxp(path, {'root': waves})
+
+
+def write_case(path, case):
+    if 'records' in case:
+        write_pxp(path, case)
+    else:
+        write_ibw(path, case)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def get_peak_rss(rusage=None):
+    """Return the peak RSS in MiB (``None`` if it is unavailable)."""
+    if resource is None:
+        return None
+    if rusage is None:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss / 2.0**20  # bytes
+    return rusage.ru_maxrss / 2.0**10  # kilobytes
+
+
+def time_script(script, path):
+    """Time a command line script, returning its time and peak RSS."""
+    command = [sys.executable, os.path.join(_BIN_DIR, script),
+               '-f', path, '-o', os.devnull]
+    start = time.time()
+    process = subprocess.Popen(command)
+    if hasattr(os, 'wait4'):
+        pid,status,rusage = os.wait4(process.pid, 0)
+        process.returncode = status
+        peak_rss = get_peak_rss(rusage)
+    else:
+        process.wait()
+        peak_rss = None
+    seconds = time.time() - start
+    if process.returncode:
+        raise RuntimeError('{} failed ({})'.format(command, process.returncode))
+    return (seconds, peak_rss)
+
+
+def run_case(case, path, repeat):
+    """Time a case in this process (see ``measure``)."""
+    result = {'start_rss_MiB': get_peak_rss()}
+    benchmark = case['benchmark']
+    if benchmark.startswith('bin/'):
+        runs = [time_script(os.path.basename(benchmark), path)
+                for i in range(repeat)]
+        result['seconds'] = min(seconds for seconds,peak_rss in runs)
+        result['start_rss_MiB'] = None
+        result['peak_rss_MiB'] = runs[0][1]
+        return result
+    if benchmark == 'binarywave.save':
+        data = loadibw(path)
+        function = lambda path: saveibw(path, data)
+    elif benchmark == 'igorpy.lookup':
+        # look up every wave in the (flat) root folder by path
+        root = loadigorpy(path)
+        paths = ['root:{}'.format(child.name) for child in root.children]
+        result['lookups'] = len(paths)
+        function = lambda path: [root.lookup(p) for p in paths]
+    else:
+        function = {
+            'read': read,
+            'binarywave.load': loadibw,
+            'packed.load': loadpxp,
+            'igorpy.load': loadigorpy,
+            }[benchmark]
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(path)
+        times.append(time.time() - start)
+    result['seconds'] = min(times)
+    result['peak_rss_MiB'] = get_peak_rss()
+    return result
+
+
+def measure(case, directory, repeat):
+    """Write the file for a case and time it in a fresh process."""
+    path = os.path.join(
+        directory, 'case.pxp' if 'records' in case else 'case.ibw')
+    write_case(path, case)
+    try:
+        output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), '--run',
+                json.dumps(case), path, str(repeat)])
+        result = dict(case)
+        result.update(json.loads(output.decode('utf-8')))
+        result['file_size'] = os.path.getsize(path)
+    finally:
+        os.remove(path)
+    seconds = max(result['seconds'], 1e-9)
+    if 'lookups' in result:
+        # the file size and record count do not describe lookups
+        lookups = max(result['lookups'], 1)
+        result['lookups/s'] = lookups / seconds
+        result['us/lookup'] = seconds / lookups * 1e6
+        return result
+    result['MB/s'] = result['file_size'] / 1e6 / seconds
+    if 'records' in case:
+        result['records/s'] = case['records'] / seconds
+    return result
+
+
+def describe(result):
+    if 'records' in result:
+        return '{benchmark} {records} records'.format(**result)
+    description = '{benchmark} {type} v{version} {byte_order} {size} B'.format(
+        **result)
+    if result.get('note_size', None):
+        description += ' + {note_size} B note'.format(**result)
+    return description
+
+
+def format_result(result):
+    if 'lookups/s' in result:
+        rate = '{:10.0f} lookups/s {:10.3f} us/lookup'.format(
+            result['lookups/s'], result['us/lookup'])
+    else:
+        rate = '{:10.1f} MB/s'.format(result['MB/s'])
+    if 'records/s' in result:
+        rate += ' {:10.0f} records/s'.format(result['records/s'])
+    peak_rss = result['peak_rss_MiB']
+    return '{:55s} {:10.2f} ms {} {}'.format(
+        describe(result), result['seconds'] * 1e3, rate,
+        '' if peak_rss is None else '{:8.1f} MiB RSS'.format(peak_rss))
+
+
+def get_key(result):
+    return tuple(result.get(key, None) for key in CASE_KEYS)
+
+
+def compare(results, old_results, threshold):
+    """Print the cases that slowed down by more than ``threshold``.
+
+    Returns the number of regressions.
+
+    >>> old = [{'benchmark': 'read', 'size': 1, 'seconds': 1.0},
+    ...        {'benchmark': 'packed.load', 'records': 10, 'seconds': 1.0}]
+    >>> new = [{'benchmark': 'read', 'size': 1, 'seconds': 1.1},
+    ...        {'benchmark': 'packed.load', 'records': 10, 'seconds': 2.0}]
+    >>> compare(new, old, threshold=1.2)
+    regression: packed.load 10 records: 1000.00 ms -> 2000.00 ms (2.00x)
+    1
+    """
+    old = dict((get_key(result), result) for result in old_results)
+    regressions = 0
+    for result in results:
+        previous = old.get(get_key(result), None)
+        if previous is None:
+            continue
+        ratio = result['seconds'] / max(previous['seconds'], 1e-9)
+        if ratio > threshold:
+            regressions += 1
+            print('regression: {}: {:.2f} ms -> {:.2f} ms ({:.2f}x)'.format(
+                    describe(result), previous['seconds'] * 1e3,
+                    result['seconds'] * 1e3, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=lambda s: split(s, parse_size),
+        default=[2**10, 2**20, 16 * 2**20],
+        help='comma-separated binary wave sizes, e.g. 1K,1M,1G')
+    parser.add_argument(
+        '--types', type=split, default=sorted(TYPES) + ['text'],
+        help='comma-separated wave types (default: {})'.format(
+            ','.join(sorted(TYPES) + ['text'])))
+    parser.add_argument(
+        '--versions', type=lambda s: split(s, int), default=[1, 2, 3, 5],
+        help='comma-separated binary wave versions')
+    parser.add_argument(
+        '--byte-orders', type=split, default=['<', '>'],
+        help="comma-separated byte orders ('<' and/or '>')")
+    parser.add_argument(
+        '--note-size', type=parse_size, default=2**20,
+        help='note size for the large-note float32 waves (0 to skip them)')
+    parser.add_argument(
+        '--records', type=lambda s: split(s, int),
+        default=[10, 100, 1000, 10000],
+        help='comma-separated numbers of packed experiment records')
+    parser.add_argument(
+        '--cli-max-size', type=parse_size, default=16 * 2**20,
+        help='largest binary wave to time with bin/igorbinarywave.py')
+    parser.add_argument(
+        '--cli-max-records', type=int, default=10000,
+        help='largest experiment to time with bin/igorpackedexperiment.py')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='time each case this many times and keep the best')
+    parser.add_argument(
+        '--output', metavar='FILE',
+        help='save the results to this JSON file')
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='compare with results saved by an earlier --output')
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help='slowdown ratio reported as a regression by --compare')
+    parser.add_argument(
+        '--run', nargs=3, metavar=('CASE', 'PATH', 'REPEAT'),
+        help=argparse.SUPPRESS)  # time a single case (internal)
+    args = parser.parse_args()
+
+    if args.run:
+        case,path,repeat = args.run
+        print(json.dumps(run_case(json.loads(case), path, int(repeat))))
+        return
+    unknown = set(args.types) - set(TYPES) - set(['text'])
+    if unknown:
+        parser.error('unknown types: {}'.format(', '.join(sorted(unknown))))
+
+    results = []
+    directory = tempfile.mkdtemp(prefix='igor-benchmark-')
+    try:
+        for case in get_cases(args):
+            result = measure(case, directory, args.repeat)
+            print(format_result(result))
+            sys.stdout.flush()
+            results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                    'igor': igor.__version__,
+                    'python': platform.python_version(),
+                    'numpy': numpy.__version__,
+                    'platform': platform.platform(),
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'results': results,
+                    }, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old_results = json.load(f)['results']
+        if compare(results, old_results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,24 @@ Navigation:
 <igor.Folder root/Packages>
 >>> print(d[0])  # doctest: +ELLIPSIS
 <igor.igorpy.Variables object at 0x...>
+>>> print(d['Packages']['PolarGraphs'])
+<igor.Folder root/Packages/PolarGraphs>
+>>> print(d.lookup('root:Packages:PolarGraphs'))
+<igor.Folder root/Packages/PolarGraphs>
+>>> print(d.lookup("Packages:'WMDataBase':"))
+<igor.Folder root/Packages/WMDataBase>
+>>> print(d.Packages.lookup(':PolarGraphs'))
+<igor.Folder root/Packages/PolarGraphs>
+>>> d.lookup('root:radiusData')
+<igor.Wave radiusData data (128)>
+>>> d.lookup('root:radiusData:x')
+Traceback (most recent call last):
+  ...
+KeyError: 'radiusData is not a folder'
+>>> d.Packages.lookup('root:radiusData')
+Traceback (most recent call last):
+  ...
+KeyError: 'root:radiusData is not in root:Packages'
 
 
 Variables:
@@ -84,11 +102,36 @@ Waves:
 <igor.Wave W_plrX5 data (128)>
 >>> dir(d.W_plrX5)  # doctest: +ELLIPSIS
 ['__array__', ..., 'axis', 'axis_units', 'data', ..., 'name', 'notes']
->>> d.W_plrX5.axis  # doctest: +ELLIPSIS
-[array([ 0.04908739,  0.04870087,  0.04831436,  0.04792784,  0.04754133,
-        0.04715481,  0.0467683 ,  0.04638178,  0.04599527,  0.04560875,
-        ...
-        0.00077303,  0.00038651,  0.        ]), array([], dtype=float64), array([], dtype=float64), array([], dtype=float64)]
+>>> d.W_plrX5.axis  # doctest: +NORMALIZE_WHITESPACE
+[<igor.Axis start 0.0490874, stop 0, n 128>,
+ <igor.Axis start 1, stop 0, n 0>,
+ <igor.Axis start 1, stop 0, n 0>,
+ <igor.Axis start 1, stop 0, n 0>]
+
+Axis values are computed on demand, without building the whole axis:
+
+>>> x = d.W_plrX5.axis[0]
+>>> print(x[1:3], x[-1])
+[0.04870087 0.04831436] 0.0
+>>> import numpy
+>>> (numpy.asarray(x) == numpy.linspace(x.start, x.stop, len(x))).all()
+True
+>>> print((x * 2)[:3])
+[0.09817477 0.09740174 0.09662871]
+>>> x.start, x.stop, len(x), x.delta == (x.stop - x.start) / (len(x) - 1)
+(0.04908738521234052, 0.0, 128, True)
+
+Axes otherwise behave like the arrays they describe:
+
+>>> y = igor.Axis(0, 1, 5)
+>>> y[[0, 2]], y[y[...] > 0.5], y[..., 1]
+(array([0. , 0.5]), array([0.75, 1.  ]), array(0.25))
+>>> y.max(), y.mean(), y.tolist()
+(1.0, 0.5, [0.0, 0.25, 0.5, 0.75, 1.0])
+>>> z = y.copy()
+>>> z[0] = 7
+>>> y[0], numpy.array(y, copy=True) is numpy.asarray(y)
+(0.0, False)
 >>> d.W_plrX5.data_units
 (u'', '', '', '')
 >>> d.W_plrX5.axis_units
@@ -124,6 +167,78 @@ root
   <Procedure>
 
 
+Load a packed experiment lazily, only converting waves when their
+data is used, and keeping at most two of them converted:
+
+>>> lazy = igor.load(data_path('polar-graphs-demo.pxp'), lazy=True,
+...                  cache_size=2)
+>>> lazy.format() == d.format()
+True
+>>> lazy.radiusData
+<igor.Wave radiusData data (128)>
+>>> lazy.radiusData._wave is None
+True
+>>> (lazy.radiusData.data == d.radiusData.data).all()
+True
+>>> lazy.angleData.notes == d.angleData.notes
+True
+>>> lazy.W_plrX5.axis  # doctest: +ELLIPSIS
+[<igor.Axis start 0.0490874, stop 0, n 128>, ...]
+>>> [w.name for w in lazy.children
+...  if isinstance(w, igor.LazyWave) and w._wave is not None]
+['angleData', 'W_plrX5']
+>>> igor.load(data_path('polar-graphs-demo.pxp'), lazy=True, cache_size=0)
+Traceback (most recent call last):
+  ...
+ValueError: cache size must be at least 1, not 0
+>>> igor.load(data_path('polar-graphs-demo.pxp'), cache_size=2)
+Traceback (most recent call last):
+  ...
+ValueError: cache_size requires lazy=True
+
+
+Load only some of the records of a packed experiment:
+
+>>> from igor.packed import RecordFilter
+>>> from igor.record.variables import VariablesRecord
+>>> d = igor.load(data_path('polar-graphs-demo.pxp'),
+...               include=RecordFilter(paths='root:*', names='^radius'),
+...               exclude=RecordFilter(record_types=VariablesRecord))
+>>> print(d.format())
+root
+  radiusData data (128)
+  radiusQ1 data (64)
+  Packages
+    WMDataBase
+    PolarGraphs
+
+
+Records replaced by appended ones are skipped, and reopened folders
+are merged:
+
+>>> import io
+>>> from igor.packed import save
+>>> with open(data_path('polar-graphs-demo.pxp'), 'rb') as f:
+...     stream = io.BytesIO(f.read())
+>>> save(stream, {'root': {
+...     b'radiusData': numpy.arange(3.0),
+...     b'Packages': {b'PolarGraphs': {
+...         b'newwave': numpy.ones(2), b'V_min': -3.0}},
+...     }}, append=True)
+>>> d = igor.loads(stream.getvalue())
+>>> d.radiusData.data
+array([0., 1., 2.])
+>>> [child.name for child in d.children if isinstance(child, igor.Folder)]
+['Packages']
+>>> d.lookup('root:Packages:PolarGraphs:newwave')
+<igor.Wave newwave data (2)>
+>>> polar_graphs = d.lookup('root:Packages:PolarGraphs')
+>>> variables = [child for child in polar_graphs.children
+...              if isinstance(child, igor.Variables)]
+>>> len(variables), variables[0].uservar[b'V_min']
+(1, -3.0)
+
+
 Load a packed experiment without ignoring unknown records:
 
 >>> d = igor.load(path, ignore_unknown=False)
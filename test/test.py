@@ -583,6 +583,461 @@ r"""Test the igor module by loading sample files.
                           'whpad3': 0,
                           'whpad4': 0}}}
 
+Memory-mapped loads view the wave data in place:
+
+>>> wave = loadibw(data_path('win-version5.ibw'), mmap=True)
+>>> wData = wave['wave']['wData']
+>>> type(wData).__name__, wData.flags.writeable
+('memmap', False)
+>>> wData.tolist()
+[5.0, 4.0, 3.0, 2.0, 1.0]
+
+Header-only loads locate each section without reading it:
+
+>>> header = loadibw_header(data_path('mac-version5.ibw'))
+>>> header['version'], header['byte_order']
+(5, '>')
+>>> header['wave']['wave_header']['npnts']
+5
+>>> for name,(offset,size) in sorted(
+...         header['sections'].items(), key=lambda item: item[1]):
+...     print('{} {} {}'.format(name, offset, size))
+wData 384 20
+formula 404 0
+note 404 15
+data_units 419 0
+dimension_units 419 0
+labels 419 64
+sIndices 483 0
+
+Parts of the wave data can be read without loading the whole wave:
+
+>>> with WaveReader(data_path('mac-version5.ibw')) as reader:
+...     print(reader.shape)
+...     print(reader[1:4])
+...     print(reader[-1])
+(5,)
+[4. 3. 2.]
+1.0
+
+Header checksums can be verified while loading, to catch corrupt
+files:
+
+>>> for filename in sorted(os.listdir(_data_dir)):
+...     if filename.endswith('.ibw'):
+...         for mmap in [False, True]:
+...             _ = loadibw(data_path(filename), mmap=mmap, checksum=True)
+>>> with open(data_path('win-version2.ibw'), 'rb') as f:
+...     corrupt = bytearray(f.read())
+>>> corrupt[24] ^= 0x01  # in the wave name
+>>> wave = loadibw(io.BytesIO(bytes(corrupt)))
+>>> print(wave['wave']['wave_header']['bname'].decode('ascii'))
+vession2
+>>> wave = loadibw(io.BytesIO(bytes(corrupt)), checksum=True)
+Traceback (most recent call last):
+  ...
+ValueError: This does not appear to be a valid Igor binary wave file.  Error in checksum: should be 0, is 1.
+
+The checksum of a version 1 wave with less than 16 bytes of data
+covers the bytes that follow it, which are peeked at without
+consuming them, even from a non-seekable stream:
+
+>>> import numpy
+>>> class Pipe (io.RawIOBase):
+...     def __init__(self, data):
+...         self.stream = io.BytesIO(data)
+...     def readable(self):
+...         return True
+...     def readinto(self, b):
+...         return self.stream.readinto(b)
+>>> stream = io.BytesIO()
+>>> saveibw(stream, {'version': 1, 'wave': {
+...     'wData': numpy.arange(2, dtype=numpy.int16)}})
+>>> short = stream.getvalue()[:-16]  # drop the trailing padding
+>>> pipe = io.BufferedReader(Pipe(short + b'\0' * 16 + b'next'))
+>>> pipe.seekable()
+False
+>>> loadibw(pipe, checksum=True)['wave']['wData']
+array([0, 1], dtype=int16)
+>>> pipe.read()
+b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00next'
+
+Loaded waves can be saved again.  Apart from the junk in the padding
+of some version 2 waves, the saved files match the originals:
+
+>>> for filename in sorted(os.listdir(_data_dir)):
+...     if not filename.endswith('.ibw'):
+...         continue
+...     path = data_path(filename)
+...     wave = loadibw(path)
+...     stream = io.BytesIO()
+...     saveibw(stream, wave, byte_order=loadibw_header(path)['byte_order'])
+...     with open(path, 'rb') as f:
+...         same = stream.getvalue() == f.read()
+...     _ = stream.seek(0)
+...     print('{} {} {}'.format(
+...         filename, same, pformat(loadibw(stream)) == pformat(wave)))
+mac-double.ibw False True
+mac-textWave.ibw True True
+mac-version2.ibw False True
+mac-version3Dependent.ibw True True
+mac-version5.ibw True True
+mac-zeroPointWave.ibw True True
+win-double.ibw True True
+win-textWave.ibw True True
+win-version2.ibw True True
+win-version5.ibw True True
+win-zeroPointWave.ibw True True
+
+New waves can be saved straight from arrays, including text and
+multi-dimensional waves:
+
+>>> import numpy
+>>> stream = io.BytesIO()
+>>> saveibw(stream, numpy.arange(6, dtype=numpy.int16).reshape((2, 3)))
+>>> _ = stream.seek(0)
+>>> wave = loadibw(stream)['wave']
+>>> print(wave['wave_header']['bname'].decode('ascii'))
+wave0
+>>> wave['wData']
+array([[0, 1, 2],
+       [3, 4, 5]], dtype=int16)
+>>> stream = io.BytesIO()
+>>> saveibw(stream, {'wave': {
+...     'wData': numpy.array([b'Mary', b'had', b'a', b'little', b'lamb']),
+...     'wave_header': {'bname': b'text0'},
+...     'note': b'A text wave.',
+...     }}, byte_order='>')
+>>> _ = stream.seek(0)
+>>> wave = loadibw(stream)['wave']
+>>> b' '.join(wave['wData']) == b'Mary had a little lamb'
+True
+>>> wave['note'] == b'A text wave.'
+True
+>>> saveibw(io.BytesIO(), numpy.zeros((2, 2)), version=2)
+Traceback (most recent call last):
+  ...
+ValueError: multi-dimensional waves need version 5, not 2
+
+Lazy packed experiment loads only decode waves when they are used:
+
+>>> records,filesystem = loadpxp(
+...     data_path('polar-graphs-demo.pxp'), lazy=True)
+>>> record = [r for r in records if isinstance(r, WaveRecord)][0]
+>>> print(record.name.decode('ascii'))
+radiusData
+>>> record._wave is None
+True
+>>> record.wave['wave']['wave_header']['npnts']
+128
+>>> record.evict()
+>>> record._wave is None
+True
+
+An index of the record headers reads single records on demand:
+
+>>> index = PackedIndex(data_path('polar-graphs-demo.pxp'))
+>>> len(index.records)
+51
+>>> for entry in index.records[32:34]:
+...     print('{} {} {} {}'.format(
+...         entry['recordType'], entry['offset'], entry['numDataBytes'],
+...         ':'.join(name.decode('ascii') for name in entry['path'])))
+3 16529 654 root:radiusData
+3 17191 654 root:angleData
+>>> record = index.get('root:radiusData')
+>>> record.wave['wave']['wave_header']['npnts']
+128
+>>> index.get('root:missing')
+Traceback (most recent call last):
+  ...
+KeyError: 'root:missing'
+
+Waves can also be read in chunks straight from the experiment, here
+with the next chunk prefetched on a background thread:
+
+>>> wData = record.wave['wave']['wData']
+>>> with index.reader('root:radiusData') as reader:
+...     chunks = list(reader.iter_chunks(50, overlap=10, prefetch=True))
+>>> [chunk.shape for chunk in chunks]
+[(50,), (50,), (48,)]
+>>> all((chunk == wData[40*i:40*i + 50]).all()
+...     for i,chunk in enumerate(chunks))
+True
+
+The index can be cached in a sidecar file, which is used until the
+experiment changes:
+
+>>> import shutil, tempfile
+>>> tmp = tempfile.mkdtemp()
+>>> path = os.path.join(tmp, 'polar-graphs-demo.pxp')
+>>> _ = shutil.copy(data_path('polar-graphs-demo.pxp'), path)
+>>> PackedIndex(path, cache=True).cached
+False
+>>> sorted(os.listdir(tmp))
+['polar-graphs-demo.pxp', 'polar-graphs-demo.pxp.index']
+>>> index = PackedIndex(path, cache=True)
+>>> index.cached
+True
+>>> index.get('root:radiusData').wave['wave']['wave_header']['npnts']
+128
+>>> with open(path, 'ab') as f:
+...     _ = f.write(b'\x00' * 8)  # an empty, unused record
+>>> PackedIndex(path, cache=True).cached
+False
+>>> shutil.rmtree(tmp)
+
+Records can also be streamed one at a time, even from streams that
+cannot seek:
+
+>>> class Pipe (object):
+...     def __init__(self, data):
+...         self.stream = io.BytesIO(data)
+...     def read(self, size=-1):
+...         return self.stream.read(size)
+>>> with open(data_path('polar-graphs-demo.pxp'), 'rb') as f:
+...     pipe = Pipe(f.read())
+>>> for record,path in iter_records(pipe):
+...     if isinstance(record, (FolderStartRecord, FolderEndRecord)):
+...         print('{} {}'.format(record.__class__.__name__,
+...             ':'.join(name.decode('ascii') for name in path)))
+FolderStartRecord root:Packages
+FolderStartRecord root:Packages:WMDataBase
+FolderEndRecord root:Packages:WMDataBase
+FolderStartRecord root:Packages:PolarGraphs
+FolderEndRecord root:Packages:PolarGraphs
+FolderEndRecord root:Packages
+
+Wave and variables records can be decoded in a pool of worker
+processes, which returns the same records in the same order:
+
+>>> serial,filesystem = loadpxp(data_path('polar-graphs-demo.pxp'))
+>>> parallel,filesystem = loadpxp(
+...     data_path('polar-graphs-demo.pxp'), workers=2)
+>>> [r.__class__ for r in parallel] == [r.__class__ for r in serial]
+True
+>>> all(pformat(p.wave) == pformat(s.wave) and p.data == s.data
+...     for p,s in zip(parallel, serial) if isinstance(s, WaveRecord))
+True
+>>> all(pformat(p.variables) == pformat(s.variables)
+...     for p,s in zip(parallel, serial) if isinstance(s, VariablesRecord))
+True
+>>> import numpy
+>>> all(numpy.shares_memory(
+...         p.wave['wave']['wData'], numpy.frombuffer(p.data, numpy.uint8))
+...     for p in parallel if isinstance(p, WaveRecord))
+True
+
+Profiles attribute the time spent loading to each stage:
+
+>>> import igor
+>>> with igor.profile() as profile:
+...     records,filesystem = loadpxp(data_path('polar-graphs-demo.pxp'))
+>>> stats = profile.as_dict()
+>>> stats['packed.WaveRecord']['calls'], stats['Wave']['calls']
+(8, 8)
+>>> stats['packed.header']['reads'], stats['packed.data']['reads']
+(52, 51)
+>>> stats['packed.data']['bytes'] == sum(len(r.data) for r in records)
+True
+
+Filters select records by path, wave name, and record type.  The
+data of the other records is skipped, and only wave headers are read
+to check the names:
+
+>>> with igor.profile() as profile:
+...     records,filesystem = loadpxp(
+...         data_path('polar-graphs-demo.pxp'),
+...         include=RecordFilter(paths='root:*', names=r'^W_plr.5$'))
+>>> [r.__class__.__name__ for r in records]
+... # doctest: +NORMALIZE_WHITESPACE
+['WaveRecord', 'WaveRecord', 'FolderStartRecord', 'FolderStartRecord',
+ 'FolderEndRecord', 'FolderStartRecord', 'FolderEndRecord',
+ 'FolderEndRecord']
+>>> pprint(filesystem)  # doctest: +ELLIPSIS
+{'root': {b'Packages': {b'PolarGraphs': {}, b'WMDataBase': {}},
+          b'W_plrX5': <WaveRecord ...>,
+          b'W_plrY5': <WaveRecord ...>}}
+>>> stats = profile.as_dict()
+>>> stats['packed.data']['bytes'] < sum(len(r.data) for r in serial)
+True
+>>> records,filesystem = loadpxp(
+...     data_path('polar-graphs-demo.pxp'),
+...     exclude=RecordFilter(record_types=[UnknownRecord, 3, 5]))
+>>> sorted(set(r.__class__.__name__ for r in records))
+... # doctest: +NORMALIZE_WHITESPACE
+['FolderEndRecord', 'FolderStartRecord', 'GetHistoryRecord',
+ 'HistoryRecord', 'RecreationRecord', 'VariablesRecord']
+>>> with open(data_path('polar-graphs-demo.pxp'), 'rb') as f:
+...     paths = [(path, r.name) for r,path in iter_records(
+...         f, exclude=RecordFilter(names='Data$'))
+...         if isinstance(r, WaveRecord)]
+>>> paths  # doctest: +NORMALIZE_WHITESPACE
+[((b'root',), b'W_plrX5'), ((b'root',), b'W_plrY5'),
+ ((b'root',), b'angleQ1'), ((b'root',), b'radiusQ1'),
+ ((b'root',), b'W_plrX6'), ((b'root',), b'W_plrY6')]
+
+Wave data is a view into the record's data, which is only read once.
+With ``mmap=True`` the records' data are views into a memory map of
+the whole file:
+
+>>> import numpy
+>>> mapped,filesystem = loadpxp(
+...     data_path('polar-graphs-demo.pxp'), mmap=True)
+>>> type(mapped[-1].data)
+<class 'memoryview'>
+>>> all(pformat(m.wave) == pformat(s.wave) and m.data == s.data
+...     for m,s in zip(mapped, serial) if isinstance(s, WaveRecord))
+True
+>>> all(pformat(m.variables) == pformat(s.variables)
+...     for m,s in zip(mapped, serial) if isinstance(s, VariablesRecord))
+True
+>>> all(m.text == s.text
+...     for m,s in zip(mapped, serial) if isinstance(s, TextRecord))
+True
+>>> for records in [serial, mapped]:
+...     record = [r for r in records if isinstance(r, WaveRecord)][0]
+...     print(numpy.shares_memory(
+...         record.wave['wave']['wData'],
+...         numpy.frombuffer(record.data, dtype=numpy.uint8)))
+True
+True
+
+Parsing is thread-safe, so waves and experiments with different
+versions and byte orders can be loaded concurrently from a pool of
+threads:
+
+>>> import sys
+>>> from multiprocessing.pool import ThreadPool
+>>> def parse(filename):
+...     path = data_path(filename)
+...     if filename.endswith('.pxp'):
+...         records,filesystem = loadpxp(path)
+...         return pformat([getattr(r, 'wave', getattr(r, 'variables', None))
+...                         for r in records])
+...     return pformat((loadibw(path), loadibw_header(path)))
+>>> filenames = [
+...     'mac-version2.ibw', 'win-version5.ibw', 'mac-version3Dependent.ibw',
+...     'win-version2.ibw', 'mac-version5.ibw', 'win-textWave.ibw',
+...     'mac-double.ibw', 'polar-graphs-demo.pxp'] * 8
+>>> serial = [parse(filename) for filename in filenames]
+>>> switch_interval = sys.getswitchinterval()
+>>> sys.setswitchinterval(1e-6)  # switch threads as often as possible
+>>> pool = ThreadPool(8)
+>>> threaded = pool.map(parse, filenames)
+>>> pool.close()
+>>> pool.join()
+>>> sys.setswitchinterval(switch_interval)
+>>> threaded == serial
+True
+
+Experiments can be saved from a filesystem dict, and waves and
+variables appended to them later.  The records they replace are
+marked as superceded, and ignored when the filesystem is built:
+
+>>> import numpy
+>>> from igor.packed import save as savepxp
+>>> def flatten(filesystem):
+...     items = []
+...     def callback(dirpath, key, value):
+...         if isinstance(value, WaveRecord):
+...             value = value.wave
+...         elif isinstance(value, dict):
+...             return
+...         items.append((dirpath, key, pformat(value)))
+...     _walk(filesystem, callback)
+...     return items
+>>> records,filesystem = loadpxp(data_path('polar-graphs-demo.pxp'))
+>>> stream = io.BytesIO()
+>>> savepxp(stream, filesystem, history=b'Saved again\r')
+>>> _ = stream.seek(0)
+>>> saved_records,saved_filesystem = loadpxp(stream)
+>>> flatten(saved_filesystem) == flatten(filesystem)
+True
+>>> tmp = tempfile.mkdtemp()
+>>> path = os.path.join(tmp, 'polar-graphs-demo.pxp')
+>>> _ = shutil.copy(data_path('polar-graphs-demo.pxp'), path)
+>>> savepxp(path, {'root': {
+...     b'radiusData': numpy.arange(3.0),
+...     b'trace': numpy.ones(2, dtype=numpy.int16),
+...     b'Packages': {b'PolarGraphs': {b'V_min': -3.0}},
+...     }}, append=True)
+>>> records,filesystem = loadpxp(path)
+>>> root = filesystem['root']
+>>> root[b'radiusData'].wave['wave']['wData']
+array([0., 1., 2.])
+>>> root[b'trace'].wave['wave']['wData']
+array([1, 1], dtype=int16)
+>>> polar_graphs = root[b'Packages'][b'PolarGraphs']
+>>> polar_graphs[b'V_min'], polar_graphs[b'V_max']
+(-3.0, 2.41585180934144)
+>>> sorted(root[b'Packages'])
+[b'PolarGraphs', b'WMDataBase']
+>>> index = PackedIndex(path)
+>>> for entry in index.records:
+...     if entry['superceded']:
+...         print('{} {}'.format(entry['recordType'], ':'.join(
+...             name.decode('ascii') for name in entry['path'])))
+3 root:radiusData
+1 root:Packages:PolarGraphs
+>>> shutil.rmtree(tmp)
+
+Appending to a stream works the same way:
+
+>>> import struct
+>>> with open(data_path('polar-graphs-demo.pxp'), 'rb') as f:
+...     stream = io.BytesIO(f.read())
+>>> savepxp(stream, {'root': {
+...     b'Packages': {b'PolarGraphs': {b'V_min': -3.0}},
+...     }}, append=True)
+>>> _ = stream.seek(0)
+>>> records,filesystem = loadpxp(stream)
+>>> polar_graphs = filesystem['root'][b'Packages'][b'PolarGraphs']
+>>> polar_graphs[b'V_min'], polar_graphs[b'V_max']
+(-3.0, 2.41585180934144)
+>>> len(records)
+56
+
+The appended variables are in reopened data folders, which are
+merged with the original ones when the experiment is loaded:
+
+>>> [record.null_terminated_text for record in records
+...  if isinstance(record, FolderStartRecord)]
+[b'Packages', b'WMDataBase', b'PolarGraphs', b'Packages', b'PolarGraphs']
+>>> sorted(filesystem['root'][b'Packages'])
+[b'PolarGraphs', b'WMDataBase']
+
+Carried over variables are saved as plain user variables, so
+appending variables next to dependent variables, which would lose
+their formulas, fails and leaves the experiment unchanged:
+
+>>> formula = b'x*2\x00'
+>>> variables = (
+...     struct.pack('=6hf', 2, 1, 0, 0, 1, 0, 0.0) +
+...     struct.pack('=32shhddlh', b'y', 1, 4, 4.0, 0, 0, len(formula)) +
+...     formula)
+>>> data = struct.pack('=Hhl', 1, 0, len(variables)) + variables
+>>> stream = io.BytesIO(data)
+>>> savepxp(stream, {'root': {b'x': 1.0}}, append=True)
+Traceback (most recent call last):
+  ...
+ValueError: cannot append variables to root: its dependent variables would lose their formulas
+>>> stream.getvalue() == data
+True
+
+Appended records follow the byte order of the experiment's headers,
+even when it is not the native one:
+
+>>> swapped = '<' if sys.byteorder == 'big' else '>'
+>>> stream = io.BytesIO(struct.pack(swapped + 'Hhl', 99, 1, 4) + b'abcd')
+>>> savepxp(stream, {'root': {b'w': numpy.arange(3.0)}}, append=True)
+>>> _ = stream.seek(0)
+>>> records,filesystem = loadpxp(stream)
+>>> records  # doctest: +ELLIPSIS
+[<UnknownRecord-99 ...>, <WaveRecord ...>]
+>>> filesystem['root'][b'w'].wave['wave']['wData']
+array([0., 1., 2.])
+
 >>> dumppxp('polar-graphs-demo.pxp')    # doctest: +REPORT_UDIFF, +ELLIPSIS
 record 0:
 <UnknownRecord-11 ...>
@@ -1447,14 +1902,21 @@ walk callback on (['root', 'Packages'], WMDataBase, {...})
 walk callback on (['root'], radiusQ1, <WaveRecord ...>)
 """
 
+import io
 import os.path
 from pprint import pformat
 
 from igor import LOG
 from igor.binarywave import load as loadibw
+from igor.binarywave import load_header as loadibw_header
+from igor.binarywave import save as saveibw
+from igor.binarywave import WaveReader
 from igor.packed import load as loadpxp
+from igor.packed import PackedIndex
+from igor.packed import RecordFilter
+from igor.packed import iter_records
 from igor.packed import walk as _walk
-from igor.record.base import TextRecord
+from igor.record.base import TextRecord, UnknownRecord
 from igor.record.folder import FolderStartRecord, FolderEndRecord
 from igor.record.variables import VariablesRecord
 from igor.record.wave import WaveRecord
@@ -1463,9 +1925,12 @@ from igor.record.wave import WaveRecord
 _this_dir = os.path.dirname(__file__)
 _data_dir = os.path.join(_this_dir, 'data')
 
-def dumpibw(filename):
+def data_path(filename):
     LOG.info('Testing {}\n'.format(filename))
-    path = os.path.join(_data_dir, filename)
+    return os.path.join(_data_dir, filename)
+
+def dumpibw(filename):
+    path = data_path(filename)
     data = loadibw(path)
     pprint(data)
 